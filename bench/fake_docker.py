@@ -0,0 +1,260 @@
+"""a Docker Engine stand-in on a unix socket
+
+Serves what the watcher asks of the daemon: GET /containers/json (sparse
+listing), /containers/<id>/json (inspect) and a chunked /events stream.
+Containers are inspect results, as bench/fleet.py makes them; starting,
+stopping and removing them changes what is listed and sends the events the
+daemon would.
+"""
+import json
+import os
+import re
+import threading
+from time import time
+
+from dateutil.parser import parse as date_parse
+
+try:
+    import socketserver
+    from http.server import BaseHTTPRequestHandler
+    from urllib.parse import parse_qs, urlparse
+except ImportError:  # python 2
+    import SocketServer as socketserver
+    from BaseHTTPServer import BaseHTTPRequestHandler
+    from urlparse import parse_qs, urlparse
+
+# /v1.39/containers/json -> /containers/json
+VERSIONED = re.compile(r"^/v[0-9.]+(/.*)$")
+# what docker sends for each change of state
+EVENTS = dict(
+    start=["start"],
+    stop=["kill", "die", "stop"],
+    destroy=["destroy"],
+)
+
+
+def epoch(created):
+    """whole seconds of an inspect Created, as the listing gives them"""
+    when = date_parse(created)
+    return int((when - date_parse("1970-01-01T00:00:00Z")).total_seconds())
+
+
+class EngineHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        match = VERSIONED.match(url.path)
+        path = match.group(1) if match else url.path
+        query = parse_qs(url.query)
+        engine = self.server.engine
+
+        if path == "/_ping":
+            return self.send_body(200, b"OK", "text/plain")
+        if path == "/version":
+            return self.send_json(200, dict(ApiVersion="1.39", Version="fake"))
+        if path == "/containers/json":
+            everything = query.get("all", ["0"])[0] in ("1", "true", "True")
+            return self.send_json(200, engine.listing(everything))
+        if path == "/events":
+            return self.stream_events()
+
+        parts = path.strip("/").split("/")
+        if len(parts) == 3 and parts[0] == "containers" and parts[2] == "json":
+            attrs = engine.inspect(parts[1])
+            if attrs is None:
+                return self.send_json(
+                    404, dict(message="No such container: %s" % (parts[1],))
+                )
+            return self.send_json(200, attrs)
+
+        self.send_json(404, dict(message="page not found"))
+
+    def send_body(self, status, body, content_type):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_json(self, status, payload):
+        self.send_body(status, json.dumps(payload).encode("utf-8"), "application/json")
+
+    def stream_events(self):
+        engine = self.server.engine
+        engine.count("event_streams")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        self.wfile.flush()
+
+        # only what happens from now on; "since" is not replayed
+        cursor = engine.cursor()
+        try:
+            while not engine.closed:
+                events, cursor = engine.wait_events(cursor, timeout=1)
+                for event in events:
+                    data = json.dumps(event).encode("utf-8") + b"\n"
+                    self.wfile.write(b"%x\r\n" % (len(data),) + data + b"\r\n")
+                self.wfile.flush()
+            self.wfile.write(b"0\r\n\r\n")
+        except (IOError, OSError):
+            # the watcher hung up
+            pass
+        self.close_connection = True
+
+
+class EngineServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        request, _address = socketserver.UnixStreamServer.get_request(self)
+        # BaseHTTPRequestHandler expects a (host, port) pair to log
+        return request, ("fake-docker", 0)
+
+
+class FakeEngine:
+    def __init__(self, path):
+        self.path = path
+        self.cond = threading.Condition()
+        # id -> inspect attrs, running or not
+        self.containers = {}
+        self.events = []
+        self.closed = False
+        self.server = None
+        self.counters = dict(lists=0, inspects=0, event_streams=0, events=0)
+
+    def start(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.server = EngineServer(self.path, EngineHandler)
+        self.server.engine = self
+        thread = threading.Thread(target=self.server.serve_forever, name="fake-docker")
+        thread.daemon = True
+        thread.start()
+        return "unix://" + self.path
+
+    def stop(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+
+    def count(self, counter):
+        with self.cond:
+            self.counters[counter] += 1
+
+    def stats(self):
+        with self.cond:
+            return dict(self.counters)
+
+    def listing(self, everything=False):
+        with self.cond:
+            self.counters["lists"] += 1
+            return [
+                self.summary(attrs)
+                for attrs in self.containers.values()
+                if everything or attrs["State"]["Running"]
+            ]
+
+    @staticmethod
+    def summary(attrs):
+        running = attrs["State"]["Running"]
+        return dict(
+            Id=attrs["Id"],
+            Names=[attrs["Name"]],
+            Image=attrs["Config"]["Image"],
+            Created=epoch(attrs["Created"]),
+            State="running" if running else "exited",
+            Status="Up" if running else "Exited (0)",
+            Labels=attrs["Config"]["Labels"],
+            NetworkSettings=dict(Networks=attrs["NetworkSettings"]["Networks"]),
+        )
+
+    def inspect(self, container_id):
+        with self.cond:
+            self.counters["inspects"] += 1
+            attrs = self.containers.get(container_id)
+            return json.loads(json.dumps(attrs)) if attrs else None
+
+    def running(self):
+        with self.cond:
+            return set(
+                cid for cid, attrs in self.containers.items()
+                if attrs["State"]["Running"]
+            )
+
+    def add(self, attrs, announce=True):
+        """a container created and started"""
+        with self.cond:
+            self.containers[attrs["Id"]] = attrs
+            self.set_running(attrs, True)
+            if announce:
+                self.emit(attrs, "start")
+
+    def start_container(self, container_id):
+        with self.cond:
+            attrs = self.containers[container_id]
+            self.set_running(attrs, True)
+            self.emit(attrs, "start")
+
+    def stop_container(self, container_id):
+        with self.cond:
+            attrs = self.containers[container_id]
+            self.set_running(attrs, False)
+            self.emit(attrs, "stop")
+
+    def remove(self, container_id):
+        with self.cond:
+            attrs = self.containers.pop(container_id)
+            if attrs["State"]["Running"]:
+                self.set_running(attrs, False)
+                self.emit(attrs, "stop")
+            self.emit(attrs, "destroy")
+
+    @staticmethod
+    def set_running(attrs, running):
+        attrs["State"].update(
+            Status="running" if running else "exited", Running=running
+        )
+
+    def emit(self, attrs, change):
+        # holding the lock
+        now = time()
+        for status in EVENTS[change]:
+            self.events.append(
+                dict(
+                    status=status,
+                    id=attrs["Id"],
+                    Type="container",
+                    Action=status,
+                    Actor=dict(
+                        ID=attrs["Id"],
+                        Attributes=dict(
+                            name=attrs["Name"].lstrip("/"),
+                            image=attrs["Config"]["Image"],
+                        ),
+                    ),
+                    scope="local",
+                    time=int(now),
+                    timeNano=int(now * 10 ** 9),
+                )
+            )
+            self.counters["events"] += 1
+        self.cond.notify_all()
+
+    def cursor(self):
+        with self.cond:
+            return len(self.events)
+
+    def wait_events(self, cursor, timeout):
+        with self.cond:
+            if cursor >= len(self.events) and not self.closed:
+                self.cond.wait(timeout)
+            return self.events[cursor:], len(self.events)
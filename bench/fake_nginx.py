@@ -0,0 +1,62 @@
+"""stands in for the nginx master process
+
+    python bench/fake_nginx.py <pid file>
+
+Writes its pid where the watcher looks for nginx's and answers each SIGHUP
+as nginx would, with a new worker replacing the old one. The number of
+SIGHUPs received is kept in <pid file>.hups.
+"""
+import os
+import signal
+import subprocess
+import sys
+
+
+def spawn(workers):
+    # no inherited stdio: a stray worker must not hold the harness's pipes
+    with open(os.devnull, "r+") as devnull:
+        worker = subprocess.Popen(
+            ["sleep", "86400"], stdin=devnull, stdout=devnull, stderr=devnull
+        )
+    workers.append(worker)
+    return worker
+
+
+def main():
+    pid_file = sys.argv[1]
+    hups_file = pid_file + ".hups"
+    workers = []
+    state = dict(hups=0, worker=spawn(workers))
+
+    def write_hups():
+        with open(hups_file + ".tmp", "w") as handle:
+            handle.write(str(state["hups"]))
+        os.rename(hups_file + ".tmp", hups_file)
+
+    def reload(signum, frame):
+        state["hups"] += 1
+        old, state["worker"] = state["worker"], spawn(workers)
+        old.terminate()
+        old.wait()
+        workers.remove(old)
+        write_hups()
+
+    def quit(signum, frame):
+        # a SIGTERM during a reload may find two workers
+        for worker in workers:
+            worker.terminate()
+        sys.exit(0)
+
+    signal.signal(signal.SIGHUP, reload)
+    signal.signal(signal.SIGTERM, quit)
+    write_hups()
+    with open(pid_file + ".tmp", "w") as handle:
+        handle.write("%d\n" % (os.getpid(),))
+    os.rename(pid_file + ".tmp", pid_file)
+
+    while True:
+        signal.pause()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+"""synthetic fleets behind a stand-in for docker.DockerClient
+
+Containers look like what the daemon reports for real deployments: a few
+named networks each, extra domain slots, other dns names, option labels,
+custom confs, and replicas of one service started at different times.
+"""
+import os
+import random
+
+NETWORKS = ["web", "backend", "monitoring"]
+SLOTS = ["SECOND", "THIRD", "FOURTH", "FIFTH", "SIXTH"]
+ROOT = "bench.example.com"
+
+
+class FakeContainer(object):
+    """what containers.list()/get() hand back: an id, attrs and a status"""
+
+    def __init__(self, attrs):
+        self.id = attrs["Id"]
+        self.attrs = attrs
+        self.name = attrs["Name"].lstrip("/")
+        self.status = attrs["State"]["Status"]
+
+
+class FakeContainers(object):
+    def __init__(self, containers):
+        self.by_id = dict((c.id, c) for c in containers)
+
+    def list(self, sparse=False, **kwargs):
+        return list(self.by_id.values())
+
+    def get(self, container_id):
+        return self.by_id[container_id]
+
+
+class FakeDockerClient(object):
+    def __init__(self, containers):
+        self.containers = FakeContainers(containers)
+
+    def events(self, **kwargs):
+        return iter(())
+
+
+def created(rng, base_day):
+    return "2021-%02d-%02dT%02d:%02d:%02d.%09dZ" % (
+        1 + base_day // 28 % 12,
+        1 + base_day % 28,
+        rng.randint(0, 23),
+        rng.randint(0, 59),
+        rng.randint(0, 59),
+        rng.randint(0, 10 ** 9 - 1),
+    )
+
+
+def container_attrs(n, service, replica, rng):
+    fqdn = "svc%d.%s" % (service, ROOT)
+    env = [
+        "VIRTUAL_HOST=%s" % (fqdn,),
+        "VIRTUAL_PORT=8080",
+        "PKI_ROLE_ID=role-%d" % (service,),
+        "PKI_SECRET_ID=secret-%d" % (service,),
+        "PATH=/usr/local/sbin:/usr/local/bin:/usr/sbin:/usr/bin:/sbin:/bin",
+        "LANG=C.UTF-8",
+    ]
+    if service % 3 == 0:
+        env.append(
+            "OTHER_DNS_NAMES=%s"
+            % ",".join("alias%d-%d.%s" % (k, service, ROOT) for k in range(3))
+        )
+    # a quarter of the services answer on extra domains, up to SIXTH
+    if service % 4 == 1:
+        for slot in SLOTS[: 1 + service % len(SLOTS)]:
+            env.append(
+                "%s_VIRTUAL_HOST=%s-svc%d.%s" % (slot, slot.lower(), service, ROOT)
+            )
+
+    labels = {
+        "com.docker.compose.project": "bench",
+        "com.docker.compose.service": "svc%d" % (service,),
+    }
+    if service % 5 == 0:
+        labels["openresty.opt.weight"] = str(1 + service % 3)
+        labels["openresty.opt.max_fails"] = "3"
+    if service % 7 == 0:
+        labels["openresty.max_upload_size"] = "100M"
+    if service % 6 == 0:
+        labels["openresty.upstream.keepalive"] = "16"
+        labels["openresty.upstream.lb"] = (
+            "hash $remote_addr consistent" if service % 12 == 0 else "least_conn"
+        )
+
+    ip = "10.%d.%d.%d" % (n // 65536 % 256, n // 256 % 256, n % 256)
+    networks = dict(
+        (
+            name,
+            dict(
+                IPAddress=ip if name == "web" else "172.%d.%d.%d"
+                % (16 + k, n // 256 % 256, n % 256),
+                NetworkID="net-%s" % (name,),
+                Aliases=["svc%d" % (service,)],
+            ),
+        )
+        for k, name in enumerate(NETWORKS[: 1 + n % len(NETWORKS)])
+    )
+
+    container_id = "%064x" % (rng.getrandbits(256),)
+    return dict(
+        Id=container_id,
+        Name="/bench_svc%d_%d" % (service, replica + 1),
+        # older replicas first; the newest of a service serves, the rest back up
+        Created=created(rng, 300 - replica * 30 - service % 20),
+        State=dict(Status="running", Running=True),
+        Config=dict(
+            Image="registry.example.com/svc%d:%d" % (service % 50, replica),
+            Domainname="",
+            Env=env,
+            Labels=labels,
+            ExposedPorts={"8080/tcp": {}, "9090/tcp": {}} if service % 6 == 0
+            else {"8080/tcp": {}},
+        ),
+        HostConfig=dict(NetworkMode="web"),
+        NetworkSettings=dict(IPAddress="", Networks=networks),
+    )
+
+
+def fleet(size, seed=1):
+    """size containers; services run one to three replicas each"""
+    rng = random.Random(seed)
+    containers = []
+    service = 0
+    while len(containers) < size:
+        replicas = 1 + service % 3
+        for replica in range(min(replicas, size - len(containers))):
+            containers.append(
+                FakeContainer(container_attrs(len(containers), service, replica, rng))
+            )
+        service += 1
+    return containers
+
+
+def domains(containers):
+    """every domain the fleet asks to be served on, primary and slots"""
+    names = set()
+    for container in containers:
+        for item in container.attrs["Config"]["Env"]:
+            key, _sep, value = item.partition("=")
+            if key.endswith("VIRTUAL_HOST"):
+                names.add(value)
+    return sorted(names)
+
+
+def custom_confs(conf_dir, containers, every=10):
+    """a custom conf for every tenth service, as CONF_DIR/<fqdn>/*.conf"""
+    written = 0
+    for n, fqdn in enumerate(domains(containers)):
+        if n % every:
+            continue
+        directory = os.path.join(conf_dir, fqdn)
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(os.path.join(directory, "extra.conf"), "w") as conf:
+            conf.write(
+                "location /health {\n"
+                "return 200 'ok';\n"
+                "}\n"
+                "add_header X-Served-By %s;\n" % (fqdn,)
+            )
+        written += 1
+    return written
@@ -0,0 +1,346 @@
+"""time each phase of a rebuild against synthetic fleets
+
+    python bench/run.py [--sizes 10,100,1000,10000] [--repeat 3]
+                        [--save] [--tolerance 0.25]
+
+Docker is a FakeDockerClient, cert files are empty stand-ins read without
+openssl and issuance is never sent to vault; everything else (parsing,
+qualifying, grouping, rendering, tidying, writing) is the code the watcher
+runs. Per phase it reports the best wall time of --repeat runs, peak memory
+(tracemalloc where available, else how far the kernel's RSS high-water mark
+rose over the RSS the phase started from) and the objects the phase left
+allocated. Results are compared against bench/baselines.json, or stored
+there with --save.
+"""
+import argparse
+import gc
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+BASELINES = os.path.join(HERE, "baselines.json")
+sys.path.insert(0, os.path.dirname(HERE))
+
+# read by confgen at import time
+WORK_DIR = tempfile.mkdtemp(prefix="confgen-bench-")
+os.environ["CONF_DIR"] = os.path.join(WORK_DIR, "conf.d")
+os.environ["CERT_DIR"] = os.path.join(WORK_DIR, "certs")
+os.environ["TEMPLATE_CACHE_DIR"] = os.path.join(WORK_DIR, "cache")
+os.environ["CUSTOM_CONF_POLL"] = "0"
+os.environ.setdefault("LOG_LEVEL", "WARNING")
+os.environ.setdefault("GRAYLOG_PORT_ACCESS", "12201")
+os.environ.setdefault("GRAYLOG_PORT_ERROR", "12202")
+os.environ.setdefault("CA_EXPIRE", str(int(time.time()) + 10 * 365 * 86400))
+
+from confgen import gen  # noqa: E402
+from confgen.certindex import CertIndex  # noqa: E402
+from confgen.certqueue import CertQueue  # noqa: E402
+from confgen.gen import CertGen, ConfGen  # noqa: E402
+from confgen.provider import ContainerProvider  # noqa: E402
+from confgen.service import Service  # noqa: E402
+
+import fleet  # noqa: E402
+
+timer = getattr(time, "perf_counter", time.time)
+
+# below these, a slower run is noise rather than a regression
+MIN_SECONDS = 0.02
+MIN_KB = 256
+# one in this many domains has no certificate yet and queues an issuance
+MISSING_CERT_EVERY = 50
+
+
+class BenchCertIndex(CertIndex):
+    """cert files are placeholders; what openssl would say is made up"""
+
+    def inspect(self, name):
+        return dict(
+            name=name,
+            sans=[name],
+            not_after=time.time() + 90 * 86400,
+            has_key=True,
+        )
+
+
+class BenchCertQueue(CertQueue):
+    """queues issuances as usual but never starts workers to run them"""
+
+    def start(self):
+        pass
+
+
+def status_kb(field):
+    with open("/proc/self/status", "r") as status:
+        for line in status:
+            if line.startswith(field + ":"):
+                return int(line.split()[1])
+    return 0
+
+
+def reset_peak():
+    """restart VmHWM from the current RSS; False where linux does not allow it"""
+    try:
+        with open("/proc/self/clear_refs", "w") as clear_refs:
+            clear_refs.write("5")
+        return True
+    except (IOError, OSError):
+        return False
+
+
+MEMORY = "tracemalloc" if tracemalloc else "vmhwm" if reset_peak() else None
+
+
+def measure(fn, repeat, setup=None):
+    """best time of repeat runs, then one more run for memory and objects"""
+    best = None
+    for _ in range(repeat):
+        if setup:
+            setup()
+        gc.collect()
+        started = timer()
+        fn()
+        elapsed = timer() - started
+        best = elapsed if best is None else min(best, elapsed)
+
+    if setup:
+        setup()
+    gc.collect()
+    # nothing is collected mid-run, so the count covers cyclic garbage too
+    gc.disable()
+    objects = len(gc.get_objects())
+    if MEMORY == "tracemalloc":
+        tracemalloc.start()
+    elif MEMORY == "vmhwm":
+        reset_peak()
+        rss = status_kb("VmRSS")
+    try:
+        result = fn()
+        peak_kb = 0
+        if MEMORY == "tracemalloc":
+            _current, peak = tracemalloc.get_traced_memory()
+            peak_kb = peak // 1024
+        elif MEMORY == "vmhwm":
+            peak_kb = max(0, status_kb("VmHWM") - rss)
+        objects = len(gc.get_objects()) - objects
+    finally:
+        if MEMORY == "tracemalloc":
+            tracemalloc.stop()
+        gc.enable()
+    return dict(seconds=round(best, 6), peak_kb=peak_kb, objects=objects), result
+
+
+def clear(directory):
+    if os.path.isdir(directory):
+        shutil.rmtree(directory)
+    os.makedirs(directory)
+
+
+def prepare(containers):
+    """empty conf and cert dirs, custom confs and cert files for this fleet"""
+    clear(gen.CONF_DIR)
+    clear(gen.CERT_DIR)
+    custom = fleet.custom_confs(gen.CONF_DIR, containers)
+    missing = 0
+    for n, name in enumerate(fleet.domains(containers)):
+        if n % MISSING_CERT_EVERY == MISSING_CERT_EVERY - 1:
+            missing += 1
+            continue
+        for ext in ("crt", "key"):
+            open(gen.cert_file(name, ext), "w").close()
+
+    CertGen.index = BenchCertIndex(gen.CERT_DIR)
+    Service.confs.confs = None
+    ConfGen.burned = set()
+    return custom, missing
+
+
+def run(size, repeat):
+    containers = fleet.fleet(size)
+    custom, missing = prepare(containers)
+    client = fleet.FakeDockerClient(containers)
+
+    generator = ConfGen()
+    generator.certs = BenchCertQueue()
+    context = generator.render_context()
+    conf_file = os.path.join(gen.CONF_DIR, "default.conf")
+    results = {}
+
+    def phase(name, fn, setup=None):
+        results[name], result = measure(fn, repeat, setup=setup)
+        return result
+
+    def parse():
+        provider = ContainerProvider(client)
+        provider.refresh()
+        return provider.containers()
+
+    def reset_generator():
+        generator.state = {}
+        generator.fingerprints = None
+        generator.commit()
+        for path in (conf_file, gen.STATE_FILE):
+            if os.path.isfile(path):
+                os.remove(path)
+        if os.path.isdir(gen.SERVICES_DIR):
+            shutil.rmtree(gen.SERVICES_DIR)
+
+    def remove_conf():
+        generator.commit()
+        if os.path.isfile(conf_file):
+            os.remove(conf_file)
+
+    def generate():
+        generator.generate(records)
+        generator.commit()
+
+    records = phase("parse", parse)
+    phase("cert_index", CertGen.index.load)
+    phase("custom_confs", Service.confs.scan)
+    phase("qualify", lambda: [generator.qualify_container(c) for c in records])
+    services = phase("get_services", lambda: generator.get_services(records))
+    phase("set_latest", lambda: [Service.set_latest(s) for s in services])
+    phase(
+        "fingerprint",
+        lambda: [s.fingerprint(include_peers=True) for s in services],
+    )
+    template = generator.env.get_template("conf.tpl")
+    chunks = phase(
+        "render", lambda: list(template.generate(services=services, **context))
+    )
+    phase("tidy", lambda: list(ConfGen.tidy_lines(chunks)))
+    phase("write", lambda: generator.write_conf(conf_file, chunks), setup=remove_conf)
+    phase("write_unchanged", lambda: generator.write_conf(conf_file, chunks))
+
+    split = gen.SPLIT_CONFS
+    try:
+        for mode in (False, True):
+            gen.SPLIT_CONFS = mode
+            prefix = "split_" if mode else ""
+            phase(prefix + "generate_cold", generate, setup=reset_generator)
+            phase(prefix + "generate_warm", generate)
+    finally:
+        gen.SPLIT_CONFS = split
+
+    info = dict(
+        containers=len(records),
+        services=len(services),
+        custom_confs=custom,
+        missing_certs=missing,
+        issuances=generator.certs.depth(),
+    )
+    return info, results
+
+
+def compare(size, results, baseline, tolerance, same_memory):
+    regressions = []
+    for name, result in sorted(results.items()):
+        base = baseline.get(name)
+        if not base:
+            continue
+        checks = [("seconds", MIN_SECONDS)]
+        if same_memory:
+            checks.append(("peak_kb", MIN_KB))
+        for metric, floor in checks:
+            was, now = base[metric], result[metric]
+            if now > was * (1 + tolerance) and now - was > floor:
+                regressions.append(
+                    "%d containers, %s: %s %s -> %s"
+                    % (size, name, metric, was, now)
+                )
+    return regressions
+
+
+def report(size, info, results, baseline):
+    print(
+        "\n%(containers)d containers, %(services)d services, "
+        "%(custom_confs)d custom confs, %(missing_certs)d certs missing "
+        "(%(issuances)d issuances queued)" % info
+    )
+    print(
+        "%-22s %10s %10s %10s %10s"
+        % ("phase", "seconds", "baseline", "peak_kb", "objects")
+    )
+    for name, result in sorted(results.items(), key=lambda r: -r[1]["seconds"]):
+        base = baseline.get(name, {}).get("seconds")
+        print(
+            "%-22s %10.4f %10s %10d %10d"
+            % (
+                name,
+                result["seconds"],
+                "%.4f" % (base,) if base is not None else "-",
+                result["peak_kb"],
+                result["objects"],
+            )
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--sizes", default="10,100,1000,10000")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--save", action="store_true", help="store as baselines")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.25,
+        help="slowdown over the baseline counted as a regression",
+    )
+    args = parser.parse_args()
+
+    stored = {}
+    if os.path.isfile(BASELINES):
+        with open(BASELINES, "r") as handle:
+            stored = json.load(handle)
+    # peak_kb means something else under the other memory method
+    same_memory = MEMORY is not None and stored.get("memory") == MEMORY
+
+    measured = {}
+    regressions = []
+    try:
+        for size in [int(s) for s in args.sizes.split(",") if s.strip()]:
+            info, results = run(size, args.repeat)
+            baseline = stored.get("sizes", {}).get(str(size), {})
+            report(size, info, results, baseline)
+            regressions += compare(
+                size, results, baseline, args.tolerance, same_memory
+            )
+            measured[str(size)] = results
+    finally:
+        shutil.rmtree(WORK_DIR, ignore_errors=True)
+
+    if args.save:
+        sizes = dict(stored.get("sizes", {}) if same_memory else {})
+        sizes.update(measured)
+        with open(BASELINES, "w") as handle:
+            json.dump(
+                dict(
+                    python=platform.python_version(),
+                    memory=MEMORY,
+                    sizes=sizes,
+                ),
+                handle,
+                sort_keys=True,
+                indent=2,
+                separators=(",", ": "),
+            )
+            handle.write("\n")
+        print("\nbaselines saved: %s" % (BASELINES,))
+    elif regressions:
+        print("\nregressions over %d%%:" % (args.tolerance * 100,))
+        for regression in regressions:
+            print("  " + regression)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,409 @@
+"""replay an event storm against the real Watcher, with no outside services
+
+    python bench/storm.py [--containers 300] [--restarts 200] [--window 10]
+                          [--kind restart|redeploy|mixed] [--certs 20]
+                          [--vault-latency 0.05] [--vault-errors 0.0]
+                          [--record FILE | --replay FILE] [--timeout 300]
+
+The watcher talks to bench/fake_docker.py over a unix socket (DOCKER_HOST),
+to bench/fake_vault.py over http (VAULT_ADDR) and reloads
+bench/fake_nginx.py by its pid file; /cert requests go through the listener
+app and the control socket. It first waits for the fleet to be served, then
+replays the storm and waits again. Converged means no rebuild, issuance or
+reload is pending and the last config serves exactly the running
+containers.
+
+Storms are JSON lines of {"at": seconds, "action": ..., "container": name},
+actions being stop, start, create (a new replica of the named container),
+remove and cert. --record writes the generated storm, --replay reads one.
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+WORK_DIR = tempfile.mkdtemp(prefix="confgen-storm-")
+
+import fleet  # noqa: E402
+from fake_docker import FakeEngine  # noqa: E402
+from fake_vault import FakeVault  # noqa: E402
+
+# a wrapping token is 26 characters; every WRAPPED_EVERY'th service hands one in
+WRAPPED_EVERY = 4
+POLL = 0.02
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[int(round(p / 100.0 * (len(values) - 1)))]
+
+
+def generate_storm(names, restarts, window, kind, certs, rng):
+    """restarts containers cycled within window, with certs /cert requests"""
+    actions = []
+    for n, name in enumerate(rng.sample(names, min(restarts, len(names)))):
+        at = rng.uniform(0, window)
+        gap = rng.uniform(0.2, 2.0)
+        redeploy = kind == "redeploy" or (kind == "mixed" and n % 2)
+        if redeploy:
+            actions.append(dict(at=at, action="create", container=name))
+            actions.append(dict(at=at + gap, action="remove", container=name))
+        else:
+            actions.append(dict(at=at, action="stop", container=name))
+            actions.append(dict(at=at + gap, action="start", container=name))
+    for name in rng.sample(names, min(certs, len(names))):
+        actions.append(dict(at=rng.uniform(0, window), action="cert", container=name))
+    return sorted(actions, key=lambda a: a["at"])
+
+
+def wrap_secrets(containers):
+    """some services hand in wrapping tokens, unwrapped (once) by vault"""
+    for container in containers:
+        env = container.attrs["Config"]["Env"]
+        for n, item in enumerate(env):
+            if item.startswith("PKI_SECRET_ID=secret-"):
+                service = int(item.rsplit("-", 1)[1])
+                if service % WRAPPED_EVERY == 0:
+                    env[n] = "PKI_SECRET_ID=%026d" % (service,)
+
+
+class Storm:
+    def __init__(self, engine, containers, listener, rng):
+        self.engine = engine
+        self.listener = listener
+        self.rng = rng
+        # container name -> id, as the storm moves them around
+        self.ids = dict((c.name, c.id) for c in containers)
+        self.clones = 0
+        # actions naming a container an earlier one removed
+        self.skipped = 0
+        # seconds until /cert answered, and until its job was done
+        self.cert_accepts = []
+        self.cert_latencies = []
+        self.cert_failures = []
+        self.cert_threads = []
+        self.lock = threading.Lock()
+
+    def replay(self, actions, started):
+        for action in actions:
+            delay = started + action["at"] - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            self.apply(action)
+
+    def apply(self, action):
+        name = action["container"]
+        container_id = self.ids.get(name)
+        if container_id is None:
+            self.skipped += 1
+            return
+        kind = action["action"]
+        if kind == "stop":
+            self.engine.stop_container(container_id)
+        elif kind == "start":
+            self.engine.start_container(container_id)
+        elif kind == "create":
+            self.engine.add(self.clone(name, container_id))
+        elif kind == "remove":
+            self.engine.remove(container_id)
+            del self.ids[name]
+        elif kind == "cert":
+            thread = threading.Thread(target=self.request_cert, args=(container_id,))
+            thread.daemon = True
+            thread.start()
+            self.cert_threads.append(thread)
+
+    def clone(self, name, container_id):
+        """a new replica of the container, created now"""
+        attrs = self.engine.inspect(container_id)
+        self.clones += 1
+        attrs["Id"] = "%064x" % (self.rng.getrandbits(256),)
+        attrs["Name"] = "/%s_r%d" % (name, self.clones)
+        attrs["Created"] = datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+        attrs["NetworkSettings"]["Networks"]["web"]["IPAddress"] = "10.255.%d.%d" % (
+            self.clones // 256 % 256,
+            self.clones % 256,
+        )
+        return attrs
+
+    def request_cert(self, container_id):
+        attrs = self.engine.inspect(container_id)
+        env = fleet_env(attrs)
+        started = time.time()
+        client = self.listener.test_client()
+        response = client.post(
+            "/cert",
+            data=json.dumps(
+                dict(
+                    domain=env["VIRTUAL_HOST"],
+                    secret_id="renewed-%s" % (container_id[:12],),
+                )
+            ),
+            content_type="application/json",
+        )
+        if response.status_code != 202:
+            with self.lock:
+                self.cert_failures.append(response.status_code)
+            return
+        with self.lock:
+            self.cert_accepts.append(time.time() - started)
+        status = json.loads(response.get_data(as_text=True))["status"]
+        state = None
+        while time.time() - started < 600:
+            job = json.loads(client.get(status).get_data(as_text=True))
+            # an error answer carries a message instead
+            state = job.get("state") or job.get("message")
+            if state not in ("queued", "issuing", "reloading"):
+                break
+            time.sleep(POLL)
+        with self.lock:
+            if state == "done":
+                self.cert_latencies.append(time.time() - started)
+            else:
+                self.cert_failures.append(state)
+
+    def wait_certs(self, timeout):
+        for thread in self.cert_threads:
+            thread.join(timeout)
+
+
+def fleet_env(attrs):
+    return dict(item.split("=", 1) for item in attrs["Config"]["Env"])
+
+
+def converged(watcher, engine, pid_file):
+    scheduler = watcher.scheduler.stats()
+    reloads = watcher.reloads.stats()
+    return (
+        not scheduler["running"]
+        and scheduler["queue_depth"] == 0
+        and watcher.generator.certs.depth() == 0
+        and not reloads["pending"]
+        # a reload sent from the controller's timer may still be underway
+        and reloads["reloads"] == read_hups(pid_file)
+        and watcher.generator.upstream_ids == engine.running()
+    )
+
+
+def wait_converged(watcher, engine, pid_file, timeout):
+    """seconds waited, or None if it did not converge in time"""
+    started = time.time()
+    while time.time() - started < timeout:
+        if converged(watcher, engine, pid_file):
+            return time.time() - started
+        time.sleep(POLL)
+    return None
+
+
+def last_conf_write(conf_dir):
+    latest = 0
+    for dirpath, dirnames, files in os.walk(conf_dir):
+        # the staged tree only holds links and test copies
+        dirnames[:] = [name for name in dirnames if not name.startswith(".")]
+        for name in files:
+            if name.endswith(".conf"):
+                latest = max(latest, os.path.getmtime(os.path.join(dirpath, name)))
+    return latest
+
+
+def read_hups(pid_file):
+    try:
+        with open(pid_file + ".hups", "r") as handle:
+            return int(handle.read().strip() or 0)
+    except (IOError, OSError, ValueError):
+        return 0
+
+
+def snapshot(watcher, engine, vault, pid_file):
+    return dict(
+        rebuilds=watcher.scheduler.stats()["rebuilds"],
+        reloads=watcher.reloads.stats()["reloads"],
+        sighups=read_hups(pid_file),
+        docker=engine.stats(),
+        vault=vault.stats(),
+    )
+
+
+def delta(before, after):
+    if isinstance(after, dict):
+        return dict((k, delta(before.get(k, 0), v)) for k, v in after.items())
+    return after - before
+
+
+def report(title, waited, counts, extra=None):
+    print("\n" + title)
+    print(
+        "  converged:       %s"
+        % ("after %.2fs" % (waited,) if waited is not None else "NO (timed out)")
+    )
+    for key, value in sorted((extra or {}).items()):
+        print("  %-16s %s" % (key + ":", value))
+    print("  rebuilds:        %d" % (counts["rebuilds"],))
+    print("  reloads:         %d (SIGHUPs received: %d)" % (counts["reloads"], counts["sighups"]))
+    print(
+        "  docker:          %s"
+        % ", ".join("%s=%d" % item for item in sorted(counts["docker"].items()))
+    )
+    print(
+        "  vault:           %s"
+        % ", ".join("%s=%d" % item for item in sorted(counts["vault"].items()))
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--containers", type=int, default=300)
+    parser.add_argument("--restarts", type=int, default=200)
+    parser.add_argument("--window", type=float, default=10.0, help="seconds")
+    parser.add_argument(
+        "--kind", choices=["restart", "redeploy", "mixed"], default="restart"
+    )
+    parser.add_argument("--certs", type=int, default=20, help="/cert requests")
+    parser.add_argument("--vault-latency", type=float, default=0.05)
+    parser.add_argument("--vault-errors", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--record", help="write the generated storm here")
+    parser.add_argument("--replay", help="replay a recorded storm instead")
+    parser.add_argument("--timeout", type=float, default=300.0)
+    parser.add_argument("--json", help="also write the results here")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    containers = fleet.fleet(args.containers, seed=args.seed)
+    wrap_secrets(containers)
+
+    engine = FakeEngine(os.path.join(WORK_DIR, "docker.sock"))
+    vault = FakeVault(latency=args.vault_latency, error_rate=args.vault_errors)
+    for container in containers:
+        engine.add(container.attrs, announce=False)
+
+    pid_file = os.path.join(WORK_DIR, "nginx.pid")
+    # read by confgen at import time
+    os.environ["DOCKER_HOST"] = engine.start()
+    os.environ["VAULT_ADDR"] = vault.start()
+    os.environ["VAULT_PKI"] = vault.pki
+    os.environ["CONF_DIR"] = os.path.join(WORK_DIR, "conf.d")
+    os.environ["CERT_DIR"] = os.path.join(WORK_DIR, "certs")
+    os.environ["TEMPLATE_CACHE_DIR"] = os.path.join(WORK_DIR, "cache")
+    os.environ["CONTROL_SOCKET"] = os.path.join(WORK_DIR, "confgen.sock")
+    os.environ["NGINX_PID_FILE"] = pid_file
+    os.environ["NGINX_TEST_COMMAND"] = "true"
+    os.environ["NGINX_CONF"] = os.path.join(WORK_DIR, "nginx.conf")
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    os.environ.setdefault("GRAYLOG_PORT_ACCESS", "12201")
+    os.environ.setdefault("GRAYLOG_PORT_ERROR", "12202")
+    os.environ.setdefault("CA_EXPIRE", str(int(time.time()) + 10 * 365 * 86400))
+    for directory in ("conf.d", "certs"):
+        os.makedirs(os.path.join(WORK_DIR, directory))
+    with open(os.environ["NGINX_CONF"], "w") as conf:
+        conf.write("http {\n    include %s/*.conf;\n}\n" % (os.environ["CONF_DIR"],))
+
+    nginx = subprocess.Popen([sys.executable, os.path.join(HERE, "fake_nginx.py"), pid_file])
+    try:
+        while not os.path.exists(pid_file):
+            time.sleep(POLL)
+
+        from confgen.watcher import Watcher
+        import gen_listener
+
+        started = time.time()
+        watcher = Watcher()
+        # as gen_watch.py does
+        watcher.serve_control()
+        thread = threading.Thread(target=watcher.begin_watch, name="watch")
+        thread.daemon = True
+        thread.start()
+
+        waited = wait_converged(watcher, engine, pid_file, args.timeout)
+        counts = snapshot(watcher, engine, vault, pid_file)
+        report(
+            "startup: %d containers" % (len(containers),),
+            None if waited is None else time.time() - started,
+            counts,
+        )
+        results = dict(startup=dict(converged=waited, counts=counts))
+
+        if args.replay:
+            with open(args.replay, "r") as handle:
+                actions = [json.loads(line) for line in handle if line.strip()]
+        else:
+            actions = generate_storm(
+                sorted(c.name for c in containers),
+                args.restarts,
+                args.window,
+                args.kind,
+                args.certs,
+                rng,
+            )
+        if args.record:
+            with open(args.record, "w") as handle:
+                for action in actions:
+                    handle.write(json.dumps(action, sort_keys=True) + "\n")
+
+        before = snapshot(watcher, engine, vault, pid_file)
+        storm = Storm(engine, containers, gen_listener.app, rng)
+        storm_started = time.time()
+        storm.replay(actions, storm_started)
+        replayed = time.time() - storm_started
+        storm.wait_certs(args.timeout)
+        waited = wait_converged(watcher, engine, pid_file, args.timeout)
+        converged_after = None if waited is None else time.time() - storm_started
+        counts = delta(before, snapshot(watcher, engine, vault, pid_file))
+
+        latencies = storm.cert_latencies
+        extra = {
+            "actions": "%d over %.1fs, %d skipped"
+            % (len(actions), replayed, storm.skipped),
+            "last conf write": "%.2fs after the storm began"
+            % (last_conf_write(os.environ["CONF_DIR"]) - storm_started,),
+            "/cert done": "%d, failed %d" % (len(latencies), len(storm.cert_failures)),
+        }
+        if storm.cert_accepts:
+            extra["/cert answered"] = "p50 %.3fs  max %.3fs" % (
+                percentile(storm.cert_accepts, 50),
+                max(storm.cert_accepts),
+            )
+        if latencies:
+            extra["/cert latency"] = "p50 %.2fs  p95 %.2fs  p99 %.2fs  max %.2fs" % (
+                percentile(latencies, 50),
+                percentile(latencies, 95),
+                percentile(latencies, 99),
+                max(latencies),
+            )
+        report("storm: %s" % (args.replay or args.kind,), converged_after, counts, extra)
+        results["storm"] = dict(
+            converged=converged_after,
+            counts=counts,
+            cert_accepts=sorted(storm.cert_accepts),
+            cert_latencies=sorted(latencies),
+            cert_failures=storm.cert_failures,
+        )
+
+        if args.json:
+            with open(args.json, "w") as handle:
+                json.dump(results, handle, sort_keys=True, indent=2, separators=(",", ": "))
+                handle.write("\n")
+        if converged_after is None:
+            sys.exit(1)
+    finally:
+        nginx.terminate()
+        nginx.wait()
+        engine.stop()
+        vault.stop()
+        shutil.rmtree(WORK_DIR, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
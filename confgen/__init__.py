@@ -6,11 +6,11 @@ def truthy(n):
     return str(n).lower().strip() not in ["0", "no", "false", "n"]
 
 
-CONF_DIR = "/etc/nginx/conf.d"
-CERT_DIR = "/etc/nginx/certs"
-
 log_level = logging.INFO
 environ = os.environ.get
+
+CONF_DIR = environ("CONF_DIR", "/etc/nginx/conf.d")
+CERT_DIR = environ("CERT_DIR", "/etc/nginx/certs")
 user_log_level = environ("LOG_LEVEL", log_level)
 if not isinstance(user_log_level, int):
     level = getattr(logging, str(user_log_level).upper(), None)
@@ -2,8 +2,8 @@ import json
 import logging
 import os
 
-import hvac
-import requests
+from metrics import vault_call_seconds, vault_errors
+from vault import vault_client, VaultUnavailable
 
 logger = logging.getLogger(__name__)
 env = os.environ.get
@@ -31,16 +31,18 @@ def unwrap_file(secret_file):
 
 
 def unwrap_token(token):
-    unwrap_client = hvac.Client(
-        url=env("VAULT_ADDR"), verify=env("REQUESTS_CA_BUNDLE"), token=token
-    )
+    return vault_client.unwrap(token)
 
-    facts = unwrap_client.sys.unwrap()
-    if facts:
-        return facts.get("data").get("secret_id")
 
+def login(role_id, secret_id, burn=None):
+    """client token for the approle, or None
 
-def login(role_id, secret_id):
+    burn(secret_id) is called once vault has answered for the secret; if it
+    can't be had, VaultUnavailable is raised and the secret is not burned (a
+    secret vault did spend is refused, and burned, on the next attempt).
+    A wrapping token unwrapped before vault went away is not unwrapped again;
+    the secret_id it held is kept for the next attempt.
+    """
     token = env("VAULT_TOKEN", None)
     if token:
         return token
@@ -51,6 +53,13 @@ def login(role_id, secret_id):
                 prop + " is not set. No appRole exchange can happen without it."
             )
 
+    # keyed by the secret as given, so replicas sharing their env log in once
+    token = vault_client.cached_token(role_id, secret_id)
+    if token:
+        logger.debug("using cached token for role " + str(role_id))
+        return token
+
+    given_secret_id = secret_id
     if os.path.isfile(secret_id):
         secret_id = unwrap_file(secret_id)
     elif len(secret_id) == 26:
@@ -59,31 +68,36 @@ def login(role_id, secret_id):
             unwrapped = unwrap_token(secret_id)
             logger.debug("unwrapped: " + str(unwrapped))
             secret_id = unwrapped
+        except VaultUnavailable:
+            raise
         except Exception as e:
+            # a spent wrapping token can't be unwrapped twice
+            if burn:
+                burn(given_secret_id)
             logger.exception(e)
             pass
 
-    login_url = "{vault_addr}/v1/auth/approle/login".format(
-        vault_addr=env("VAULT_ADDR")
-    )
-    logger.debug(login_url)
-
-    payload = dict(
-        secret_id=secret_id,
-        role_id=role_id,
-    )
-    logger.debug(str(payload))
-
     try:
-        response = requests.post(login_url, json=payload).json()
+        with vault_call_seconds.labels("login").time():
+            response = vault_client.login(role_id, secret_id)
+    except VaultUnavailable:
+        vault_errors.labels("login", "unavailable").inc()
+        raise
     except Exception as e:
+        vault_errors.labels("login", "failed").inc()
         logger.exception(e)
         return bail("Failed requesting a vault auth login. (Secret-Id expired?)")
 
+    if burn:
+        burn(given_secret_id)
+    vault_client.forget_unwrapped(given_secret_id)
+
     if "errors" in response:
+        vault_errors.labels("login", "rejected").inc()
         return bail("\n".join(response["errors"]))
 
     if "auth" not in response:
         return bail("Response contains no auth object")
 
+    vault_client.cache_token(role_id, given_secret_id, response["auth"])
     return response["auth"]["client_token"]
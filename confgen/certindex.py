@@ -0,0 +1,147 @@
+import os
+import subprocess
+import threading
+from time import time
+
+from dateutil.parser import parse as date_parse
+
+from . import logger, CERT_DIR
+
+
+def epoch(when):
+    return (when - date_parse("1970-01-01T00:00:00Z")).total_seconds()
+
+
+def san_keys(name):
+    """the SANs that would cover name: itself and the wildcard over its parent"""
+    keys = [name]
+    if "." in name:
+        # a wildcard covers exactly one label
+        keys.append("*." + name.split(".", 1)[1])
+    return keys
+
+
+class CertIndex:
+    """what CERT_DIR holds: names, SANs, expiry and key presence, read once"""
+
+    def __init__(self, cert_dir=CERT_DIR):
+        self.cert_dir = cert_dir
+        self.lock = threading.Lock()
+        # cert name -> dict(name, sans, not_after, has_key)
+        self.certs = None
+        # SAN, as written ("*.example.com" for a wildcard) -> names of certs with it
+        self.sans = {}
+
+    def path(self, name, ext="crt"):
+        return self.cert_dir + "/" + name + "." + ext
+
+    def load(self):
+        certs = {}
+        if os.path.isdir(self.cert_dir):
+            for filename in os.listdir(self.cert_dir):
+                if filename.endswith(".crt"):
+                    name = filename[: -len(".crt")]
+                    certs[name] = self.inspect(name)
+        sans = {}
+        for cert in certs.values():
+            for san in cert["sans"]:
+                sans.setdefault(san, set()).add(cert["name"])
+        with self.lock:
+            self.certs = certs
+            self.sans = sans
+        logger.info("cert index loaded; certs = %d" % (len(certs),))
+
+    def get(self, name):
+        if self.certs is None:
+            self.load()
+        with self.lock:
+            cert = self.certs.get(name)
+        if cert is None and os.path.isfile(self.path(name)):
+            # dropped into the volume by hand since the index was loaded
+            cert = self.refresh(name)
+        return cert
+
+    def exists(self, name):
+        return self.get(name) is not None
+
+    def refresh(self, name):
+        """re-read one cert after it was written"""
+        cert = self.inspect(name) if os.path.isfile(self.path(name)) else None
+        with self.lock:
+            if self.certs is None:
+                self.certs = {}
+            previous = self.certs.pop(name, None)
+            for san in previous["sans"] if previous else []:
+                holders = self.sans.get(san)
+                if holders is not None:
+                    holders.discard(name)
+                    if not holders:
+                        del self.sans[san]
+            if cert:
+                self.certs[name] = cert
+                for san in cert["sans"]:
+                    self.sans.setdefault(san, set()).add(name)
+        return cert
+
+    def all(self):
+        if self.certs is None:
+            self.load()
+        with self.lock:
+            return list(self.certs.values())
+
+    def covering(self, names, min_remaining=0):
+        """a cert with a key whose SANs cover every name and outlives min_remaining
+
+        Looked up by SAN, so the cost is in the names rather than the certs.
+        """
+        if self.certs is None:
+            self.load()
+        deadline = time() + min_remaining
+        candidates = None
+        with self.lock:
+            for name in names:
+                holders = set()
+                for key in san_keys(name):
+                    holders.update(self.sans.get(key, ()))
+                candidates = holders if candidates is None else candidates & holders
+                if not candidates:
+                    return None
+            certs = [self.certs[name] for name in sorted(candidates or ())]
+        for cert in certs:
+            if not cert["has_key"] or not cert["not_after"]:
+                continue
+            if cert["not_after"] <= deadline:
+                continue
+            return cert["name"]
+        return None
+
+    def inspect(self, name):
+        sans = []
+        not_after = None
+        try:
+            text = subprocess.check_output(
+                [
+                    "openssl", "x509", "-in", self.path(name),
+                    "-noout", "-enddate", "-text",
+                ],
+                stderr=subprocess.STDOUT,
+            ).decode("utf-8", "replace")
+            lines = text.splitlines()
+            for n, line in enumerate(lines):
+                if line.startswith("notAfter="):
+                    not_after = epoch(date_parse(line.split("=", 1)[1]))
+                if "Subject Alternative Name" in line and n + 1 < len(lines):
+                    sans = [
+                        san.strip()[len("DNS:"):]
+                        for san in lines[n + 1].split(",")
+                        if san.strip().startswith("DNS:")
+                    ]
+        except (subprocess.CalledProcessError, OSError, ValueError) as e:
+            logger.warning("could not read certificate %s: %s" % (name, e))
+
+        return dict(
+            name=name,
+            sans=sans,
+            not_after=not_after,
+            has_key=os.path.isfile(self.path(name, ext="key")),
+        )
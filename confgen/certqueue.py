@@ -0,0 +1,75 @@
+import threading
+
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
+
+from . import environ, logger
+
+CERT_WORKERS = int(environ("CERT_WORKERS", 4))
+
+
+class CertQueue:
+    """bounded pool issuing certificates off the rebuild path"""
+
+    def __init__(self, workers=CERT_WORKERS, on_done=None):
+        self.workers = max(1, workers)
+        # called with the job keys and whether the certificate landed
+        self.on_done = on_done
+        self.jobs = Queue()
+        self.lock = threading.Lock()
+        self.pending = set()
+        self.threads = []
+
+    def submit(self, keys, fn, *args, **kwargs):
+        """queue fn unless a job holding any of keys is queued or running
+
+        keys is one key or a list of them; the first names the job
+        """
+        keys = keys if isinstance(keys, list) else [keys]
+        with self.lock:
+            if any(key in self.pending for key in keys):
+                return False
+            self.pending.update(keys)
+            if not self.threads:
+                self.start()
+        self.jobs.put((keys, fn, args, kwargs))
+        return True
+
+    def is_pending(self, key):
+        with self.lock:
+            return key in self.pending
+
+    def depth(self):
+        with self.lock:
+            return len(self.pending)
+
+    def start(self):
+        for n in range(self.workers):
+            thread = threading.Thread(target=self.work, name="certs-%d" % (n,))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def work(self):
+        while True:
+            keys, fn, args, kwargs = self.jobs.get()
+            key = keys[0]
+            ready = False
+            try:
+                ready = fn(*args, **kwargs)
+            except Exception as e:
+                logger.exception(e)
+
+            logger.info("certificate %s: %s" % (key, "ready" if ready else "failed"))
+            try:
+                # still pending meanwhile, so a caller checking is_pending
+                # right after submit cannot miss the outcome
+                if self.on_done:
+                    self.on_done(keys, ready)
+            except Exception as e:
+                logger.exception(e)
+            finally:
+                with self.lock:
+                    self.pending.difference_update(keys)
@@ -1,21 +1,102 @@
 import re
+from collections import OrderedDict
+from time import time
 
 from dateutil.parser import parse as date_parse
 
+import tracing
 from . import environ, logger
 
 NGINX_OPTION_PREFIX = environ("NGINX_OPTION_PREFIX", "openresty")
 
+# extra domains a container can carry: any env prefix that names a domain of its
+# own, as SECOND_SERVICE_FQDN, 7_VIRTUAL_HOST or API_SERVICE_FQDN
+SLOT_DOMAIN_KEYS = ["SERVICE_FQDN", "VIRTUAL_HOST"]
+# ordinal slots come first, in this order, then numbered ones, then by name
+ORDINALS = ["second", "third", "fourth", "fifth", "sixth"]
+
+# cleared in a domain slot unless the slot sets its own
+SLOT_KEYS = [
+    "SERVICE_FQDN",
+    "VIRTUAL_HOST",
+    "VIRTUAL_PORT",
+    "CERT_NAME",
+    "OTHER_DNS_NAMES",
+    "PKI_ROLE",
+    "PKI_SECRET_ID",
+]
+
+LABEL_ENV_OPTS = [
+    "default_server",
+    "cert_name",
+    "serve_http",
+    "proxy_pass",
+    "skip_root_location",
+    "render_confs",
+    "auth_basic_file",
+    "auth_cert_bundle",
+    "required_group",
+    "max_upload_size",
+]
+
+# service-wide upstream block settings, as openresty.upstream.<setting> labels,
+# each with the values nginx takes for it
+UPSTREAM_SETTINGS = [
+    (
+        "lb",
+        re.compile(
+            r"^(least_conn|ip_hash|hash [^\s;{}]+( consistent)?"
+            r"|random( two( least_conn)?)?)$"
+        ),
+    ),
+    ("keepalive", re.compile(r"^[1-9][0-9]*$")),
+    ("keepalive_requests", re.compile(r"^[1-9][0-9]*$")),
+    ("keepalive_timeout", re.compile(r"^[0-9]+(ms|s|m|h|d)?$")),
+]
+
+# everything read from env (or labels overriding env); differs per domain slot
+SETTINGS = [
+    "env",
+    "service_fqdn",
+    "upstream",
+    "other_names",
+    "nginx_use_other_names",
+    "exposed_port",
+    "secret_id",
+    "role_id",
+    "pki_role",
+] + LABEL_ENV_OPTS
+
+
+class Container(object):
+    """one inspect result, parsed once and read-only afterwards
+
+    Domain slots and cert reuse are ContainerView overlays on top of it.
+    """
 
-class Container:
     local_domain = environ("LOCAL_DOMAIN", "bibby.local")
 
-    def __init__(self, container, env=None):
+    __slots__ = [
+        "container",
+        "name",
+        "image",
+        "domain_name",
+        "labels",
+        "exposures",
+        "network",
+        "ip_address",
+        "options",
+        "upstream_conf",
+        "slots",
+        "_created",
+    ] + SETTINGS
+
+    def __init__(self, container):
         name = container.attrs.get("Name", "").lstrip("/")
         config = container.attrs.get("Config", {})
-        env = env or Container.fmt_env(config.get("Env", []))
-        labels = config.get("Labels", {})
-        exposures = Container.fmt_exposure(config.get("ExposedPorts", {}))
+        env = Container.fmt_env(config.get("Env", []))
+        labels = config.get("Labels") or {}
+        exposures = Container.fmt_exposure(config.get("ExposedPorts") or {})
 
         network_mode = container.attrs.get("HostConfig", {}).get(
             "NetworkMode", None
@@ -46,15 +127,107 @@ class Container:
             if label in labels:
                 options.append("=".join([option, labels[label]]))
 
+        fields = dict(
+            container=container,
+            name=name,
+            image=config.get("Image"),
+            domain_name=config.get("Domainname", None),
+            labels=labels,
+            exposures=exposures,
+            network=network_mode,
+            ip_address=ip_address,
+            options=" ".join(map(str, options)),
+            upstream_conf=Container.fmt_upstream(name, labels),
+            slots=Container.index_slots(env),
+            _created=None,
+        )
+        fields.update(
+            Container.settings(env, labels, fields["domain_name"], exposures)
+        )
+        for k, v in fields.items():
+            object.__setattr__(self, k, v)
+
+        logger.debug("? name = %s", name)
+
+    def __getattr__(self, name):
+        if name == "container":
+            raise AttributeError(name)
+        return getattr(self.container, name)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("container records are read-only; use replace()")
+
+    @staticmethod
+    def fmt_env(env_pairs):
+        """["FOO=bar", "BAR=baz"]
+        to {'FOO': 'bar', 'BAR': 'baz'}
+        """
+        env_map = {k: v for k, v in tuple(item.split("=", 1) for item in env_pairs)}
+        logger.debug(env_map)
+        return env_map
+
+    @staticmethod
+    def fmt_exposure(exposures):
+        return [ex.split("/", 1)[0] for ex in exposures]
+
+    @staticmethod
+    def fmt_upstream(name, labels):
+        """{"lb": "least_conn", "keepalive": "16"} from openresty.upstream.* labels
+
+        A value nginx would refuse is left out, so one container cannot fail
+        the whole config.
+        """
+        conf = {}
+        for setting, valid in UPSTREAM_SETTINGS:
+            label = ".".join([NGINX_OPTION_PREFIX, "upstream", setting])
+            if label not in labels:
+                continue
+            value = " ".join(labels[label].split())
+            if valid.match(value):
+                conf[setting] = value
+            else:
+                logger.warning("%s: ignoring %s=%s", name, label, value)
+        return conf
+
+    @staticmethod
+    def slot_order(ns):
+        if ns.lower() in ORDINALS:
+            return 0, ORDINALS.index(ns.lower()), ns
+        if ns.isdigit():
+            return 1, int(ns), ns
+        return 2, 0, ns
+
+    @staticmethod
+    def index_slots(env):
+        """OrderedDict of slot -> its own env, e.g. {"SECOND": {"SERVICE_FQDN": ..}}"""
+        prefixes = set()
+        for k in env:
+            for key in SLOT_DOMAIN_KEYS:
+                if k.endswith("_" + key) and len(k) > len(key) + 1:
+                    prefixes.add(k[:-len(key) - 1])
+        if not prefixes:
+            return OrderedDict()
+
+        slots = OrderedDict(
+            (ns, {}) for ns in sorted(prefixes, key=Container.slot_order)
+        )
+        for k, v in env.items():
+            # longest declared prefix wins, so API_V2_ is not read as API_
+            cut = k.rfind("_")
+            while cut > 0:
+                if k[:cut] in slots:
+                    slots[k[:cut]][k[cut + 1:]] = v
+                    break
+                cut = k.rfind("_", 0, cut)
+        return slots
+
+    @staticmethod
+    def settings(env, labels, domain_name, exposures):
         # precedence order
         service_fqdn = env.get("SERVICE_FQDN", None)
-        domain_name = config.get("Domainname", None)
         virtual_host = env.get("VIRTUAL_HOST", None)
         service_name = env.get("SERVICE_NAME", None)
 
-        secret_id = env.get("PKI_SECRET_ID", None)
-        role_id = env.get("PKI_ROLE_ID", None)
-
         if not service_fqdn:
             if domain_name:
                 service_fqdn = domain_name
@@ -65,9 +238,7 @@ class Container:
                     map(str, [virtual_host, Container.local_domain])
                 )
 
-        pki_role = env.get("PKI_ROLE", service_fqdn)
         other_names = env.get("OTHER_DNS_NAMES", None)
-
         if other_names:
             other_names = set(
                 [n.strip() for n in re.split("[, ]*", other_names) if n.strip()]
@@ -81,116 +252,108 @@ class Container:
                 nginx_use_other_names.lower() in ("no", "false", "0"):
             nginx_use_other_names = False
 
-        def get_env_opt(opt):
+        # custom port, else the first exposure; 0 for a freestyle container
+        exposed_port = env.get("VIRTUAL_PORT", None) or (
+            exposures[0] if exposures else 0
+        )
+
+        settings = dict(
+            env=env,
+            service_fqdn=service_fqdn,
+            upstream=service_fqdn,
+            other_names=other_names,
+            nginx_use_other_names=nginx_use_other_names,
+            exposed_port=exposed_port,
+            secret_id=env.get("PKI_SECRET_ID", None),
+            role_id=env.get("PKI_ROLE_ID", None),
+            pki_role=env.get("PKI_ROLE", service_fqdn),
+        )
+        for opt in LABEL_ENV_OPTS:
             opt_label = ".".join([NGINX_OPTION_PREFIX, opt])
-            return labels.get(opt_label, None) or env.get(opt.upper(), None)
-
-        label_env_opts = [
-            "default_server",
-            "cert_name",
-            "serve_http",
-            "proxy_pass",
-            "skip_root_location",
-            "render_confs",
-            "auth_basic_file",
-            "auth_cert_bundle",
-            "required_group",
-            "max_upload_size",
-        ]
-
-        label_opts = dict()
-        for opt in label_env_opts:
-            label_opts[opt] = get_env_opt(opt)
-
-        self.container = container
-        self.name = name
-        self.env = env
-        self.image = config.get("Image")
-        self.labels = labels
-        self.exposures = exposures
-        self.service_fqdn = service_fqdn
-        self.upstream = service_fqdn
-        self.other_names = other_names
-        self.nginx_use_other_names = nginx_use_other_names
-        self.network = network_mode
-        self.ip_address = ip_address
-        self.default_server = label_opts["default_server"]
-        self.options = " ".join(map(str, options))
-        self.proxy_pass = label_opts["proxy_pass"]
-        self.cert_name = label_opts["cert_name"]
-        self.exposed_port = self.get_exposed_port()
-        self.secret_id = secret_id
-        self.role_id = role_id
-        self.pki_role = pki_role
-        self.serve_http = label_opts["serve_http"]
-        self.skip_root_location = label_opts["skip_root_location"]
-        self.render_confs = label_opts["render_confs"]
-        self.auth_basic_file = label_opts["auth_basic_file"]
-        self.auth_cert_bundle = label_opts["auth_cert_bundle"]
-        self.required_group = label_opts["required_group"]
-        self.max_upload_size = label_opts["max_upload_size"]
+            settings[opt] = labels.get(opt_label, None) or env.get(opt.upper(), None)
 
-        logger.debug("? name = %s", name)
-        logger.debug("? label_opts = %s", label_opts)
+        logger.debug("? settings = %s", settings)
+        return settings
 
-    def __getattr__(self, name):
-        return getattr(self.container, name)
+    def variant(self, ns):
+        """the container as seen through one slot's env vars"""
+        overlay = self.slots.get(ns)
+        if not overlay:
+            return None
 
-    @staticmethod
-    def fmt_env(env_pairs):
-        """["FOO=bar", "BAR=baz"]
-        to {'FOO': 'bar', 'BAR': 'baz'}
-        """
-        env_map = {k: v for k, v in tuple(item.split("=", 1) for item in env_pairs)}
-        logger.debug(env_map)
-        return env_map
+        # a slot always names its own domain, so the Domainname is not a fallback
+        return ContainerView(
+            self,
+            Container.settings(SlotEnv(self.env, overlay), self.labels, None, self.exposures),
+        )
 
-    def rotate_env(self, ns):
-        ns = ns + "_"
-        env = self.env
-
-        important_keys = [
-            "SERVICE_FQDN",
-            "VIRTUAL_HOST",
-            "VIRTUAL_PORT",
-            "CERT_NAME",
-            "OTHER_DNS_NAMES",
-            "PKI_ROLE",
-            "PKI_SECRET_ID",
-        ]
-
-        for k in important_keys:
-            if k in env:
-                del env[k]
-
-        for k in env.keys():
-            if not k.startswith(ns):
-                continue
+    def variants(self):
+        for ns in self.slots:
+            yield ns, self.variant(ns)
 
-            logger.debug("%s <- %s", k[len(ns):], k)
-            env[k[len(ns):]] = env[k]
-        return env
+    def replace(self, **fields):
+        return ContainerView(self, fields)
 
-    def copy(self, env=None):
-        return Container(self.container, env)
+    def created_date(self):
+        if self._created is None:
+            image_date = self.labels.get("org.label-schema.build-date", None)
+            created_date = self.attrs.get("Created", None)
+            started = time()
+            object.__setattr__(self, "_created", date_parse(image_date or created_date))
+            tracing.add("dateutil", time() - started)
+        return self._created
 
-    @staticmethod
-    def fmt_exposure(exposures):
-        return [ex.split("/", 1)[0] for ex in exposures]
 
-    def get_exposed_port(self):
-        # custom port
-        custom = self.env.get("VIRTUAL_PORT", None)
-        if custom:
-            return custom
+class SlotEnv(object):
+    """a slot's env vars over the container's, without the main domain's"""
 
-        # freestyle container
-        exposed = self.exposures
-        if len(exposed) == 0:
-            return 0
-        return exposed[0]
+    __slots__ = ["base", "overlay"]
 
-    def created_date(self):
-        image_date = self.labels.get("org.label-schema.build-date", None)
-        created_date = self.attrs.get("Created", None)
-        return date_parse(image_date or created_date)
+    def __init__(self, base, overlay):
+        self.base = base
+        self.overlay = overlay
+
+    def get(self, key, default=None):
+        if key in self.overlay:
+            return self.overlay[key]
+        if key in SLOT_KEYS:
+            return default
+        return self.base.get(key, default)
+
+    def __contains__(self, key):
+        return key in self.overlay or (key not in SLOT_KEYS and key in self.base)
+
+    def __getitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        return self.get(key)
+
+
+class ContainerView(object):
+    """a Container with some settings swapped out; everything else is shared"""
+
+    __slots__ = ["base", "fields"]
+
+    def __init__(self, base, fields):
+        object.__setattr__(self, "base", base)
+        object.__setattr__(self, "fields", fields)
+
+    def __getattr__(self, name):
+        if name in ("base", "fields"):
+            raise AttributeError(name)
+        fields = self.fields
+        if name in fields:
+            return fields[name]
+        return getattr(self.base, name)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("container records are read-only; use replace()")
+
+    def variants(self):
+        # a slot or a reuse of one; the other slots are not part of it
+        return iter(())
+
+    def replace(self, **fields):
+        merged = dict(self.fields)
+        merged.update(fields)
+        return ContainerView(self.base, merged)
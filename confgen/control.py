@@ -0,0 +1,94 @@
+import json
+import os
+import socket
+import threading
+
+try:
+    import socketserver
+except ImportError:  # python 2
+    import SocketServer as socketserver
+
+from . import environ, logger
+
+# the watcher owns the containers and the config; other processes ask it here
+CONTROL_SOCKET = environ("CONTROL_SOCKET", "/var/run/confgen.sock")
+CONTROL_TIMEOUT = float(environ("CONTROL_TIMEOUT", 10))
+
+
+class ControlError(Exception):
+    def __init__(self, message, status_code=400):
+        Exception.__init__(self, message)
+        self.message = message
+        self.status_code = status_code
+
+
+class ControlHandler(socketserver.StreamRequestHandler):
+    """one JSON request per line, answered by one JSON line"""
+
+    def handle(self):
+        for line in iter(self.rfile.readline, b""):
+            if not line.strip():
+                continue
+            reply = self.server.dispatch(line)
+            self.wfile.write(json.dumps(reply).encode("utf-8") + b"\n")
+            self.wfile.flush()
+
+
+class ControlServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+    # a full backlog refuses unix connects outright (EAGAIN), not later
+    request_queue_size = 128
+
+    def __init__(self, handlers, path=CONTROL_SOCKET):
+        self.handlers = handlers
+        if os.path.exists(path):
+            # left over from a previous run
+            os.unlink(path)
+        socketserver.UnixStreamServer.__init__(self, path, ControlHandler)
+        os.chmod(path, 0o600)
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, name="control")
+        thread.daemon = True
+        thread.start()
+        logger.info("control socket listening on %s" % (self.server_address,))
+
+    def dispatch(self, line):
+        try:
+            request = json.loads(line.decode("utf-8"))
+            command = request.pop("command", None)
+            if command not in self.handlers:
+                raise ControlError("unknown command: %s" % (command,))
+            return dict(ok=True, result=self.handlers[command](**request))
+        except ControlError as e:
+            return dict(ok=False, error=e.message, status=e.status_code)
+        except Exception as e:
+            logger.exception(e)
+            return dict(ok=False, error=str(e), status=400)
+
+
+class ControlClient:
+    def __init__(self, path=CONTROL_SOCKET, timeout=CONTROL_TIMEOUT):
+        self.path = path
+        self.timeout = timeout
+
+    def call(self, command, **kwargs):
+        """run a command in the watcher; raises ControlError for its errors"""
+        kwargs["command"] = command
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.path)
+            sock.sendall(json.dumps(kwargs).encode("utf-8") + b"\n")
+            reply = sock.makefile("rb").readline()
+        except (socket.error, socket.timeout) as e:
+            raise ControlError("watcher unavailable: %s" % (e,), status_code=503)
+        finally:
+            sock.close()
+
+        if not reply:
+            raise ControlError("watcher closed the connection", status_code=503)
+        reply = json.loads(reply.decode("utf-8"))
+        if not reply.get("ok"):
+            raise ControlError(reply.get("error"), status_code=reply.get("status", 400))
+        return reply.get("result")
@@ -0,0 +1,134 @@
+import hashlib
+import os
+import threading
+from time import sleep, time
+
+import tracing
+from . import environ, logger, CONF_DIR
+
+# seconds between checks of CONF_DIR/<fqdn>/ for edited custom confs
+CUSTOM_CONF_POLL = float(environ("CUSTOM_CONF_POLL", 5))
+
+
+class CustomConfStore:
+    """custom confs under CONF_DIR/<fqdn>/, read once and re-read when edited
+
+    Files are checked by mtime and size; only changed ones are read again.
+    """
+
+    def __init__(self, conf_dir=CONF_DIR, skip=("services",)):
+        self.conf_dir = conf_dir
+        # subdirectories of conf_dir that hold no custom confs
+        self.skip = set(skip)
+        self.lock = threading.Lock()
+        # fqdn -> [(path, mtime, size, content, sha1)], ordered by path
+        self.confs = None
+        self.thread = None
+
+    @staticmethod
+    def read(path):
+        with open(path, "r") as conf:
+            content = conf.read()
+        data = content if isinstance(content, bytes) else content.encode("utf-8")
+        return content, hashlib.sha1(data).hexdigest()
+
+    def scan_service(self, fqdn, known):
+        """the confs of one service, re-using what is unchanged in known"""
+        known = dict((entry[0], entry) for entry in known)
+        entries = []
+        paths = []
+        for dirpath, _dirnames, files in os.walk(os.path.join(self.conf_dir, fqdn)):
+            paths.extend(os.path.join(dirpath, f) for f in files)
+
+        for path in sorted(paths):
+            try:
+                stat = os.stat(path)
+                entry = known.get(path)
+                if entry is None or entry[1:3] != (stat.st_mtime, stat.st_size):
+                    content, sha1 = CustomConfStore.read(path)
+                    entry = (path, stat.st_mtime, stat.st_size, content, sha1)
+            except (IOError, OSError) as e:
+                # removed or unreadable mid-scan; the next scan catches up
+                logger.warning("custom conf %s: %s" % (path, e))
+                continue
+            entries.append(entry)
+        return entries
+
+    def scan(self):
+        """re-check every service directory; returns the fqdns that changed"""
+        started = time()
+        fqdns = []
+        if os.path.isdir(self.conf_dir):
+            fqdns = [
+                name
+                for name in os.listdir(self.conf_dir)
+                if name not in self.skip
+                and os.path.isdir(os.path.join(self.conf_dir, name))
+            ]
+
+        with self.lock:
+            # the first scan loads; it changes nothing anyone has seen
+            initial = self.confs is None
+            known = dict(self.confs or {})
+
+        confs = {}
+        for fqdn in fqdns:
+            entries = self.scan_service(fqdn, known.get(fqdn, []))
+            if entries:
+                confs[fqdn] = entries
+
+        changed = sorted(
+            fqdn
+            for fqdn in set(confs) | set(known)
+            if CustomConfStore.hashes(confs.get(fqdn))
+            != CustomConfStore.hashes(known.get(fqdn))
+        )
+        with self.lock:
+            self.confs = confs
+        tracing.add("custom_confs.scan", time() - started)
+        return [] if initial else changed
+
+    @staticmethod
+    def hashes(entries):
+        return [(entry[0], entry[4]) for entry in entries or []]
+
+    def get(self, fqdn):
+        """contents of the service's custom confs, ordered by path"""
+        if self.confs is None:
+            self.scan()
+        with self.lock:
+            return [entry[3] for entry in self.confs.get(fqdn, [])]
+
+    def digest(self, fqdn):
+        """one hash over the paths and contents of the service's custom confs"""
+        if self.confs is None:
+            self.scan()
+        with self.lock:
+            hashes = CustomConfStore.hashes(self.confs.get(fqdn))
+        if not hashes:
+            return None
+        digest = hashlib.sha1()
+        for path, sha1 in hashes:
+            digest.update(path.encode("utf-8"))
+            digest.update(sha1.encode("utf-8"))
+        return digest.hexdigest()
+
+    def start(self, on_change, interval=CUSTOM_CONF_POLL):
+        """poll for edits; on_change gets the fqdns whose confs changed"""
+        if self.thread or interval <= 0:
+            return
+        self.thread = threading.Thread(
+            target=self.run, args=(on_change, interval), name="custom-confs"
+        )
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self, on_change, interval):
+        while True:
+            sleep(interval)
+            try:
+                changed = self.scan()
+                if changed:
+                    on_change(changed)
+            except Exception as e:
+                logger.exception(e)
@@ -1,13 +1,19 @@
+import hashlib
 import json
 import os
+import shutil
 from time import time
 
-import requests
-from jinja2 import Environment, PackageLoader, select_autoescape
-
+import tracing
 from approle import login
-from container import Container
+from certindex import CertIndex
+from certqueue import CertQueue
+from metrics import certificates, timed, vault_call_seconds, vault_errors
+from rendering import prewarm, templates
+from renewal import RENEW_BEFORE
 from service import Service
+from upstreams import UpstreamSync, DYNAMIC_UPSTREAMS
+from vault import vault_client, VaultUnavailable
 from . import environ, truthy, logger, CONF_DIR, CERT_DIR
 
 VTS_ENABLED = truthy(environ("VTS_ENABLED"))
@@ -20,6 +26,15 @@ GRAYLOG_DOMAIN = environ("GRAYLOG_DOMAIN")
 GRAYLOG_PORT_ACCESS = int(environ("GRAYLOG_PORT_ACCESS"))
 GRAYLOG_PORT_ERROR = int(environ("GRAYLOG_PORT_ERROR"))
 
+# one conf per service under SERVICES_DIR, rewritten only when its inputs change
+SPLIT_CONFS = truthy(environ("SPLIT_CONFS", 0))
+SERVICES_DIR = CONF_DIR + "/services"
+# digests of the inputs behind default.conf; not a *.conf, so nginx skips it
+STATE_FILE = CONF_DIR + "/default.conf.state"
+# the tree nginx -t checks before anything is promoted into CONF_DIR; a dot
+# dir, so no include glob of the running config reaches it
+STAGE_DIR = CONF_DIR + "/.staged"
+
 CA_EXPIRE = int(environ("CA_EXPIRE"))
 CA_BUFFER_TIME = int(environ("CA_BUFFER_TIME", 3600 * 3))
 SIX_MON = 15552000
@@ -29,6 +44,14 @@ def cert_file(domain, ext="crt"):
     return CERT_DIR + "/" + domain + "." + ext
 
 
+def service_file(fqdn):
+    return SERVICES_DIR + "/" + fqdn + ".conf"
+
+
+def staged_file(conf_file):
+    return STAGE_DIR + conf_file[len(CONF_DIR):]
+
+
 def pretty_json(dict_obj):
     return json.dumps(dict_obj, sort_keys=True, indent=4, separators=(",", ": "))
 
@@ -40,24 +63,245 @@ class ConfGen:
 
     def __init__(self, **kwargs):
         self.certgen = CertGen(**kwargs)
-        self.env = Environment(
-            loader=PackageLoader("confgen", "templates"),
-            autoescape=select_autoescape(["tpl"]),
-        )
+        # issuance runs here; a rebuild only serves certs that already exist
+        self.certs = CertQueue()
+        # cert name -> issuance arguments of the service using it, for renewals
+        self.cert_owners = {}
+        # certs due for renewal without credentials to renew them, logged once
+        self.unrenewable = set()
+        # ids of the containers serving in the last generated config
+        self.upstream_ids = set()
+        # shared and compiled up front; rebuilds only render
+        self.env = templates
+        prewarm()
+        # fqdn -> fingerprint of its conf under SERVICES_DIR (split mode)
+        self.fingerprints = None
+        # inputs behind default.conf, persisted in STATE_FILE (single mode)
+        self.state = None
+        # why the last generate() changed the config
+        self.reason = None
+        # seconds the last generate() spent per phase, and the services it found
+        self.timings = ConfGen.no_timings()
+        self.service_count = 0
+        # the last generate()'s services and their fingerprints, for a rebuild
+        # of only some of them; None until the first, and after a rollback
+        self.services = None
+        self.service_fingerprints = {}
+        # conf path -> the file to replace it with (None to remove it), until
+        # commit() moves them into place
+        self.staged = {}
+        self.upstreams = UpstreamSync()
+        self.templates_digest = self.digest_templates()
 
     @staticmethod
     def burn(secret):
         ConfGen.burned.add(secret)
 
-    def generate(self, client):
-        services = self.get_services(client)
+    @staticmethod
+    def no_timings():
+        return dict(qualify=0.0, render=0.0, tidy=0.0, write=0.0)
+
+    def generate(self, containers, fqdns=None):
+        """render and stage the confs; True when nginx needs a reload
+
+        With fqdns, only those services' custom confs changed: the services
+        of the last generate() are reused rather than qualified again.
+        """
+        self.timings = ConfGen.no_timings()
+        targeted = fqdns is not None and self.services is not None
+        started = time()
+        if targeted:
+            services = self.services
+            for service in services:
+                if service.fqdn in fqdns:
+                    service.custom_confs = Service.confs.get(service.fqdn)
+        else:
+            with tracing.span("get_services"):
+                services = self.get_services(containers)
+        self.timings["qualify"] = time() - started
+        self.service_count = len(services)
         logger.info("services = %d" % (len(services),))
+
+        with tracing.span("fingerprint"):
+            context = self.render_context()
+            context_digest = self.digest_context(context)
+            # with dynamic upstreams, peers stay out of the conf and its fingerprint
+            fingerprints = dict(self.service_fingerprints) if targeted else {}
+            for service in services:
+                if targeted and service.fqdn not in fqdns:
+                    continue
+                fingerprints[service.fqdn] = ConfGen.digest(
+                    context_digest,
+                    service.fingerprint(include_peers=not DYNAMIC_UPSTREAMS),
+                )
+        self.services = services
+        self.service_fingerprints = fingerprints
+
+        with tracing.span("confs"):
+            if SPLIT_CONFS:
+                changed = self.generate_split(services, fingerprints, context)
+            else:
+                changed = self.generate_single(services, fingerprints, context)
+        # rendering, tidying and writing interleave; their sums, not spans
+        for phase in ("render", "tidy", "write"):
+            tracing.add(phase, self.timings[phase])
+        return changed
+
+    def generate_single(self, services, fingerprints, context):
+        if self.state is None:
+            self.state = ConfGen.read_state()
+
+        conf_file = CONF_DIR + "/default.conf"
+        inputs_digest = ConfGen.digest(*sorted(fingerprints.items()))
+        if self.state.get("digest") == inputs_digest and os.path.isfile(conf_file):
+            logger.debug("inputs unchanged; skipping render")
+            self.reason = None
+            return False
+
+        if not os.path.isfile(conf_file):
+            self.reason = "default.conf missing"
+        else:
+            self.reason = ConfGen.describe_changes(
+                self.state.get("services", {}), fingerprints
+            )
+
         template = self.env.get_template("conf.tpl")
+        generate_config = self.write_conf(
+            conf_file, template.generate(services=services, **context)
+        )
+        if not generate_config:
+            logger.debug("rendered conf identical to the one in place")
+            self.reason = None
+
+        self.state = dict(digest=inputs_digest, services=fingerprints)
+        ConfGen.write_state(self.state)
+        return generate_config
 
-        generate_config = True
+    def generate_split(self, services, fingerprints, context):
+        if not os.path.isdir(SERVICES_DIR):
+            os.makedirs(SERVICES_DIR)
+        if self.fingerprints is None:
+            self.fingerprints = ConfGen.read_fingerprints()
+
+        reasons = []
         conf_file = CONF_DIR + "/default.conf"
-        conf_content = template.render(
-            services=services,
+        if self.write_conf(
+            conf_file,
+            self.env.get_template("conf.tpl").generate(
+                services=[], services_dir=SERVICES_DIR, **context
+            ),
+        ):
+            reasons.append("default.conf changed")
+
+        # only files actually replaced or removed count as changes
+        previous = dict(self.fingerprints)
+        staged = set()
+        template = self.env.get_template("service.tpl")
+        for service in services:
+            fingerprint = fingerprints[service.fqdn]
+            if previous.get(service.fqdn) == fingerprint:
+                continue
+
+            logger.info("rendering service conf: %s" % (service.fqdn,))
+            if self.write_conf(
+                service_file(service.fqdn),
+                template.generate(service=service, **context),
+                header="# fingerprint: %s" % (fingerprint,),
+            ):
+                staged.add(service.fqdn)
+            self.fingerprints[service.fqdn] = fingerprint
+
+        for fqdn in set(previous) - set(fingerprints):
+            logger.info("removing service conf: %s" % (fqdn,))
+            if os.path.isfile(service_file(fqdn)):
+                self.stage(service_file(fqdn))
+                staged.add(fqdn)
+            del self.fingerprints[fqdn]
+
+        service_changes = ConfGen.describe_changes(
+            dict((fqdn, previous[fqdn]) for fqdn in staged if fqdn in previous),
+            dict((fqdn, fingerprints[fqdn]) for fqdn in staged if fqdn in fingerprints),
+        )
+        if service_changes:
+            reasons.append(service_changes)
+
+        self.reason = "; ".join(reasons) or None
+        return bool(reasons)
+
+    @staticmethod
+    def describe_changes(previous, current):
+        added = sorted(set(current) - set(previous))
+        removed = sorted(set(previous) - set(current))
+        changed = sorted(
+            fqdn
+            for fqdn in set(current) & set(previous)
+            if current[fqdn] != previous[fqdn]
+        )
+
+        reasons = []
+        for label, fqdns in (
+            ("added", added),
+            ("removed", removed),
+            ("changed", changed),
+        ):
+            if fqdns:
+                reasons.append("%s: %s" % (label, ", ".join(fqdns)))
+        if not reasons and previous != current:
+            reasons.append("settings changed")
+        return "; ".join(reasons) or None
+
+    @staticmethod
+    def digest(*parts):
+        return hashlib.sha1(
+            json.dumps(parts, sort_keys=True).encode("utf-8")
+        ).hexdigest()
+
+    def digest_context(self, context):
+        return ConfGen.digest(self.templates_digest, context)
+
+    @staticmethod
+    def read_state():
+        if os.path.isfile(STATE_FILE):
+            with open(STATE_FILE, "r") as state:
+                try:
+                    return json.loads(state.read())
+                except ValueError:
+                    logger.warning("unreadable state file: %s" % (STATE_FILE,))
+        return {}
+
+    @staticmethod
+    def write_state(state):
+        with open(STATE_FILE, "w") as handle:
+            handle.write(json.dumps(state, sort_keys=True))
+
+    @staticmethod
+    def read_fingerprints():
+        fingerprints = {}
+        for name in os.listdir(SERVICES_DIR):
+            if not name.endswith(".conf"):
+                continue
+            with open(SERVICES_DIR + "/" + name, "r") as conf:
+                header = conf.readline().strip()
+            prefix = "# fingerprint: "
+            fqdn = name[: -len(".conf")]
+            # an unreadable header still registers the file so it can be replaced
+            fingerprints[fqdn] = (
+                header[len(prefix):] if header.startswith(prefix) else None
+            )
+        return fingerprints
+
+    def digest_templates(self):
+        # template edits ship with the image; fold them into every fingerprint
+        digest = hashlib.sha1()
+        for name in sorted(self.env.list_templates()):
+            source, _filename, _uptodate = self.env.loader.get_source(self.env, name)
+            digest.update(name.encode("utf-8"))
+            digest.update(source.encode("utf-8"))
+        return digest.hexdigest()
+
+    @staticmethod
+    def render_context():
+        return dict(
             opts=dict(
                 VTS_ENABLED=VTS_ENABLED,
                 VTS_PATH=VTS_PATH,
@@ -73,94 +317,263 @@ class ConfGen:
                     error=GRAYLOG_PORT_ERROR,
                 ),
             ),
+            dynamic=UpstreamSync.render_context(),
         )
 
-        if os.path.isfile(conf_file):
-            with open(conf_file, "r") as conf:
-                prev_content = conf.read()
-                if prev_content == conf_content:
-                    generate_config = False
-
-        if generate_config:
-            with open(conf_file, "w") as conf:
-                conf.write(ConfGen.tidy(str(conf_content)))
-
-        return generate_config
-
     @staticmethod
     def tidy(contents):
-        lines = map(str.strip, contents.splitlines())
+        return "\n".join(ConfGen.tidy_lines([contents]))
+
+    @staticmethod
+    def tidy_lines(chunks):
+        """re-indent rendered chunks, one line at a time"""
         current_indent = 0
-        tidy_lines = []
-        for line in lines:
+        for line in ConfGen.split_lines(chunks):
+            line = line.strip()
             if not len(line):
                 continue
 
             if line.endswith("}"):
-                tidy_lines.append("")
+                yield ""
                 current_indent -= 1
 
             if line.endswith("{"):
-                tidy_lines.append("")
+                yield ""
 
-            tidy_lines.append(current_indent * ConfGen.INDENT + line)
+            yield current_indent * ConfGen.INDENT + line
 
             if line.endswith("{"):
                 current_indent += 1
 
-        return "\n".join(tidy_lines)
+    @staticmethod
+    def split_lines(chunks):
+        pending = ""
+        for chunk in chunks:
+            # join, not +: chunks may be Markup, which would escape the rest
+            lines = "".join((pending, chunk)).split("\n")
+            pending = lines.pop()
+            for line in lines:
+                yield line
+        yield pending
+
+    def write_conf(self, conf_file, chunks, header=None):
+        """stream a rendered conf out and stage it; False when it is unchanged
+
+        The conf is written to a dotted temp file beside it (not *.conf, so an
+        nginx reload never includes it) and staged; it only replaces the old
+        one in commit(), once nginx has accepted it. A header alone differing
+        is not a change; the file is refreshed in place for it.
+        """
+        started = time()
+        timings = self.timings
+        before = dict(timings)
+        directory, name = os.path.split(conf_file)
+        temp_file = os.path.join(directory, "." + name + ".tmp")
+        digest = hashlib.sha1()
+        with open(temp_file, "wb") as conf:
+            # rendering happens as tidy pulls chunks; timed apart from tidying
+            lines = timed(
+                ConfGen.tidy_lines(timed(chunks, timings, "render")), timings, "tidy"
+            )
+            separator = b""
+            if header is not None:
+                # left out of the digest, which covers what nginx reads
+                conf.write(header.encode("utf-8"))
+                separator = b"\n"
+            for line in lines:
+                data = separator + line.encode("utf-8")
+                separator = b"\n"
+                digest.update(data)
+                conf.write(data)
+
+            current_header, current_digest = ConfGen.digest_file(
+                conf_file, header=header is not None
+            )
+            changed = current_digest != digest.hexdigest()
+            # an identical render is thrown away; only a kept one is synced
+            if changed or current_header != header:
+                conf.flush()
+                os.fsync(conf.fileno())
+
+        if changed:
+            self.stage(conf_file, temp_file)
+        elif current_header != header:
+            os.rename(temp_file, conf_file)
+        else:
+            os.remove(temp_file)
+
+        rendered = timings["render"] - before["render"]
+        tidied = timings["tidy"] - before["tidy"] - rendered
+        timings["tidy"] = before["tidy"] + tidied
+        timings["write"] += time() - started - rendered - tidied
+        return changed
+
+    def stage(self, conf_file, new_file=None):
+        """replace conf_file with new_file, or remove it, once committed"""
+        self.staged[conf_file] = new_file
+
+    def prepare(self):
+        """lay out the confs nginx would read after commit() under STAGE_DIR
+
+        The staged confs, and hard links to the rest. Top-level confs are
+        copied with their CONF_DIR paths pointed into STAGE_DIR, so split
+        mode's default.conf includes the staged services. Returns STAGE_DIR.
+        """
+        if os.path.isdir(STAGE_DIR):
+            shutil.rmtree(STAGE_DIR)
+        os.makedirs(STAGE_DIR)
+
+        conf_files = set(self.staged)
+        for directory in (CONF_DIR, SERVICES_DIR):
+            if os.path.isdir(directory):
+                conf_files.update(
+                    directory + "/" + name
+                    for name in os.listdir(directory)
+                    if name.endswith(".conf")
+                )
+        if SPLIT_CONFS:
+            os.makedirs(staged_file(SERVICES_DIR))
+
+        live = (CONF_DIR + "/").encode("utf-8")
+        staged = (STAGE_DIR + "/").encode("utf-8")
+        for conf_file in conf_files:
+            source = self.staged.get(conf_file, conf_file)
+            if source is None or not os.path.isfile(source):
+                continue
+            target = staged_file(conf_file)
+            directory = os.path.dirname(target)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            if os.path.dirname(conf_file) == CONF_DIR:
+                with open(source, "rb") as conf:
+                    contents = conf.read()
+                with open(target, "wb") as conf:
+                    conf.write(contents.replace(live, staged))
+            else:
+                try:
+                    os.link(source, target)
+                except OSError:
+                    shutil.copy2(source, target)
+        return STAGE_DIR
+
+    def commit(self):
+        """nginx accepted the staged confs; move them into CONF_DIR
+
+        Dynamic upstreams get the last generate()'s peers only now, so a
+        rejected config leaves the balancer as it was. True when the push
+        failed and a reload is needed to load them from the snapshot.
+        """
+        for conf_file, new_file in self.staged.items():
+            if new_file:
+                os.rename(new_file, conf_file)
+            elif os.path.isfile(conf_file):
+                os.remove(conf_file)
+        self.staged = {}
+        if os.path.isdir(STAGE_DIR):
+            shutil.rmtree(STAGE_DIR)
+
+        if DYNAMIC_UPSTREAMS and self.services is not None:
+            with tracing.span("upstreams"):
+                synced = self.upstreams.sync(self.services)
+            if not synced:
+                self.reason = self.reason or "upstream push failed"
+                return True
+        return False
+
+    def rollback(self):
+        """drop the staged confs; the ones in CONF_DIR were never touched"""
+        for new_file in self.staged.values():
+            if new_file and os.path.isfile(new_file):
+                os.remove(new_file)
+        self.staged = {}
+        # what is on disk no longer matches the recorded inputs
+        self.state = {}
+        ConfGen.write_state(self.state)
+        self.fingerprints = None
+        self.services = None
 
-    def get_services(self, client):
+    @staticmethod
+    def digest_file(path, header=False):
+        """(first line or None, digest of the rest); (None, None) when missing
+
+        The rest starts with the newline ending the first line.
+        """
+        if not os.path.isfile(path):
+            return None, None
+        first = None
+        digest = hashlib.sha1()
+        with open(path, "rb") as handle:
+            if header:
+                line = handle.readline()
+                if line.endswith(b"\n"):
+                    line = line[:-1]
+                    digest.update(b"\n")
+                first = line.decode("utf-8")
+            for block in iter(lambda: handle.read(65536), b""):
+                digest.update(block)
+        return first, digest.hexdigest()
+
+    def get_services(self, containers):
         # something usable by the template
         services = {}
+        upstream_ids = set()
+        self.cert_owners = {}
         default_container = None
-        containers = map(Container, client.containers.list())
         # proxy_container = [c for c in containers if c.labels.get("openresty.proxy")]
         # if proxy_container:
         #   proxy_container = proxy_container[0]
         #   named_network = proxy_container.network
 
+        trace = tracing.current()
         for container in containers:
+            started = time()
             # pretty_json(container.attrs)
+            demoted = False
             if container.default_server:
                 if default_container:
                     msg = "%s default_server status removed, already set by %s"
                     logger.warn(msg % (container.name, default_container.name))
-                    container.default_server = False
+                    demoted = True
                 else:
-                    default_container = Container
+                    default_container = container
 
             for cont in self.qualify_container(container):
                 if cont.service_fqdn not in services:
                     services[cont.service_fqdn] = Service(
                         cont.service_fqdn, cont.upstream
                     )
-                services[cont.service_fqdn].add_container(cont)
-
-        return sorted(
-            map(Service.set_latest, services.values()),
-            key=lambda c: (c.fqdn != c.upstream, c.fqdn),
-        )
+                services[cont.service_fqdn].add_container(cont, demoted=demoted)
+                upstream_ids.add(cont.id)
+            if trace is not None:
+                trace.cost(container.service_fqdn or container.name, time() - started)
+
+        self.upstream_ids = upstream_ids
+        with tracing.span("set_latest"):
+            return sorted(
+                map(Service.set_latest, services.values()),
+                key=lambda c: (c.fqdn != c.upstream, c.fqdn),
+            )
 
     def qualify_container(self, container, force_regen=None):
         containers = []
-        if not self.__qualify_container(container, force_regen=force_regen):
+        qualified = self.__qualify_container(container, force_regen=force_regen)
+        if not qualified:
             return containers
 
-        containers.append(container)
-        for n in ["second", "third", "fourth", "fifth", "sixth"]:
-            logger.debug("Attempting additional domain: %s", n)
-            c = container.copy(container.rotate_env(n.upper()))
-            if self.__qualify_container(c, force_regen=force_regen):
-                logger.debug("%s domain is valid, adding", n)
-                containers.append(c)
+        containers.append(qualified)
+        for ns, variant in container.variants():
+            logger.debug("Attempting additional domain: %s", ns)
+            qualified = self.__qualify_container(variant, force_regen=force_regen)
+            if qualified:
+                logger.debug("%s domain is valid, adding", ns)
+                containers.append(qualified)
             else:
-                logger.debug("%s domain invalid or missing. done here.", n)
-                break
+                logger.debug("%s domain did not qualify", ns)
 
         return containers
 
     def __qualify_container(self, container, force_regen=None):
+        """the container as it should be served, or None"""
         qualified = (
                 self.__qualify_container_cfg(container)
                 and self.__qualify_container_auth(container)
@@ -169,7 +582,8 @@ class ConfGen:
 
         if qualified:
             logger.info("Adding service: %s" % (container.name,))
-        return qualified
+            return qualified
+        return None
 
     @staticmethod
     def __qualify_container_cfg(container):
@@ -240,46 +654,134 @@ class ConfGen:
         logger.info("auth passes (2/3) " + container.service_fqdn)
         return True
 
-    def __qualify_container_cert(self, container, force_regen=None):
+    @staticmethod
+    def cert_request(container):
+        """(other_names, include_short_domain) for the container's certificate"""
         if container.nginx_use_other_names:
-            other_names = container.other_names
-            include_short_domain = True
-        else:
-            logger.info("excluding short and other names for " + container.service_fqdn)
-            other_names = []
-            include_short_domain = False
+            return container.other_names, True
+        logger.info("excluding short and other names for " + container.service_fqdn)
+        return [], False
+
+    def __qualify_container_cert(self, container, force_regen=None):
+        other_names, include_short_domain = ConfGen.cert_request(container)
+
+        cert_name = container.cert_name or container.service_fqdn
+        self.cert_owners[cert_name] = (container, other_names, include_short_domain)
 
-        if not self.certgen.cert_exists(container):
+        cert_exists = self.certgen.cert_exists(container)
+        if not cert_exists:
+            # a secret handed in over /cert stands in for the container's own
+            secret_id = CertGen.secret_updates.get(
+                container.service_fqdn, container.secret_id
+            )
             if not container.role_id:
                 msg = "%s did not qualify;  missing role_id (this version requires one " \
                       "for approles) "
                 logger.info(msg % (container.name,))
-                return False
+                return None
 
-            if not container.secret_id:
+            if not secret_id:
                 msg = "%s did not qualify;  missing secret_id (this version requires one " \
                       "for approles) "
                 logger.info(msg % (container.name,))
-                return False
+                return None
+
+            if not force_regen:
+                covering = CertGen.index.covering(
+                    CertGen.cert_names(container, other_names), RENEW_BEFORE
+                )
+                if covering:
+                    logger.info(
+                        "%s reuses certificate %s covering its names"
+                        % (container.name, covering)
+                    )
+                    logger.info("cert passes (3/3) " + container.service_fqdn)
+                    return container.replace(cert_name=covering)
 
-            if container.secret_id in ConfGen.burned:
+            if secret_id in ConfGen.burned:
                 msg = "%s did not qualify;  secret_id has been burned"
                 logger.info(msg % (container.name,))
-                return False
+                return None
 
-        cert = self.certgen.ensure_certificate(
+        if cert_exists and not force_regen:
+            logger.info("cert passes (3/3) " + container.service_fqdn)
+            return container
+
+        if vault_client.breaker.is_open():
+            # fail fast and keep serving whatever certificate is in place
+            logger.info(
+                "%s: vault circuit open, not issuing %s" % (container.name, cert_name)
+            )
+        elif self.queue_certificate(
+            container, other_names, include_short_domain, force=force_regen
+        ):
+            logger.info("%s certificate queued: %s" % (container.name, cert_name))
+            tracing.add("certs.queued", 0.0)
+
+        if cert_exists:
+            # renewing; keep serving the current certificate meanwhile
+            logger.info("cert passes (3/3) " + container.service_fqdn)
+            return container
+
+        msg = "%s did not qualify; waiting on certificate"
+        logger.info(msg % (container.name,))
+        return None
+
+    def queue_certificate(self, container, other_names, include_short_domain, force):
+        # replicas and domain copies asking for the same names share one issuance;
+        # the cert name is held too, since the job writes that file
+        issue_key = (
+            container.service_fqdn,
+            tuple(CertGen.cert_names(container, other_names)),
+            container.pki_role,
+        )
+        return self.certs.submit(
+            [issue_key, container.cert_name or container.service_fqdn],
+            self.certgen.ensure_certificate,
             container,
             other_names,
-            force=force_regen,
+            force=force,
             include_short_domain=include_short_domain,
         )
 
-        if not cert:
-            msg = "%s did not qualify; error generating certificate"
-            logger.warning(msg % (container.name,))
+    def reissue(self, container):
+        """queue a forced issuance for the container, without a rebuild"""
+        if vault_client.breaker.is_open():
+            logger.info(
+                "%s: vault circuit open, not issuing %s"
+                % (container.name, container.cert_name or container.service_fqdn)
+            )
+            return False
+        other_names, include_short_domain = ConfGen.cert_request(container)
+        return self.queue_certificate(
+            container, other_names, include_short_domain, force=True
+        )
+
+    def renew(self, cert_name):
+        owner = self.cert_owners.get(cert_name)
+        if not owner:
             return False
 
-        logger.info("cert passes (3/3) " + container.service_fqdn)
+        container, other_names, include_short_domain = owner
+        secret_id = CertGen.secret_updates.get(
+            container.service_fqdn, container.secret_id
+        )
+        if (
+            (not secret_id or secret_id in ConfGen.burned)
+            and not environ("VAULT_TOKEN", None)
+            and not vault_client.has_token(container.role_id, secret_id)
+        ):
+            # a login with a spent secret is sure to be refused; wait for /cert
+            if cert_name not in self.unrenewable:
+                self.unrenewable.add(cert_name)
+                logger.warning(
+                    "cert %s is due for renewal, but its secret_id is spent and no "
+                    "token is cached; renew it through the listener" % (cert_name,)
+                )
+            return True
+
+        self.unrenewable.discard(cert_name)
+        self.queue_certificate(container, other_names, include_short_domain, force=True)
         return True
 
 
@@ -289,6 +791,7 @@ class CertGen:
     ]
 
     secret_updates = dict()
+    index = CertIndex()
 
     def __init__(self, vault_addr=None, vault_pki=None):
         self.vault_addr = vault_addr or environ("VAULT_ADDR")
@@ -305,6 +808,13 @@ class CertGen:
 
         return list(dns_names)
 
+    @staticmethod
+    def cert_names(container, other_names):
+        """the names an issued certificate carries, in canonical order"""
+        names = set(other_names or [])
+        names.add(container.service_fqdn)
+        return sorted(names)
+
     @staticmethod
     def shorten_domain(domain, root):
         domain_segments = [item.strip() for item in domain.split(".")]
@@ -321,9 +831,8 @@ class CertGen:
     def cert_exists(container):
         domain = container.service_fqdn
         cert_name = container.cert_name or domain
-        certificate = cert_file(cert_name)
-        exists = os.path.isfile(certificate)
-        logger.debug("cert_exists? %s %s", certificate, exists)
+        exists = CertGen.index.exists(cert_name)
+        logger.debug("cert_exists? %s %s", cert_name, exists)
         return exists
 
     def ensure_certificate(
@@ -334,15 +843,22 @@ class CertGen:
         cert_name = container.cert_name or domain
         if force or not self.cert_exists(container):
             try:
-                return self.generate_certificate(
+                issued = self.generate_certificate(
                     container,
                     other_names,
                     cert_name,
                     include_short_domain=include_short_domain,
                 )
+            except VaultUnavailable as e:
+                logger.warning("%s not issued; vault unavailable: %s" % (cert_name, e))
+                certificates.labels("unavailable").inc()
+                return False
             except Exception as e:
                 logger.exception(e)
+                certificates.labels("failed").inc()
                 return False
+            certificates.labels("issued" if issued else "failed").inc()
+            return issued
         return True
 
     def generate_certificate(
@@ -364,8 +880,7 @@ class CertGen:
             domains = self.sni_domains(domains)
 
         logger.debug(["Generating", [cert_name + ".crt", domains]])
-        ConfGen.burn(secret_id)
-        vault_token = login(role_id, secret_id)
+        vault_token = login(role_id, secret_id, burn=ConfGen.burn)
         if not vault_token:
             return False
 
@@ -396,14 +911,21 @@ class CertGen:
         logger.debug(str(payload))
 
         logger.debug("requesting..")
-        result = requests.post(
-            pki_url,
-            json=payload,
-            headers={"X-Vault-Token": vault_token, "Content-Type": "application/json"},
-        ).json()
+        try:
+            with vault_call_seconds.labels("issue").time():
+                result = vault_client.post(
+                    pki_url, payload=payload, token=vault_token, retry=False
+                )
+        except VaultUnavailable:
+            vault_errors.labels("issue", "unavailable").inc()
+            raise
+        except Exception:
+            vault_errors.labels("issue", "failed").inc()
+            raise
         logger.debug("responded.")
 
         if "errors" in result:
+            vault_errors.labels("issue", "rejected").inc()
             raise ValueError("\n".join(result.get("errors")))
 
         crt_file = cert_file(cert_name)
@@ -417,5 +939,6 @@ class CertGen:
         with open(key_file, "w") as f:
             f.write(result.get("data").get("private_key"))
         os.chmod(key_file, 0o600)
+        CertGen.index.refresh(cert_name)
 
         return os.path.isfile(key_file)
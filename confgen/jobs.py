@@ -0,0 +1,145 @@
+import threading
+import uuid
+from collections import OrderedDict
+from time import time
+
+from . import environ, logger
+
+# finished jobs kept around for GET /cert/jobs/<id>
+JOBS_KEEP = int(environ("CERT_JOBS_KEEP", 1000))
+
+
+class CertJobs:
+    """/cert requests, from queued issuance to the reload that serves them
+
+    An entry waits on the cert name its issuance holds in the CertQueue.
+    Once every entry of a job has been issued (or has failed), the job asks
+    for one forced rebuild and is done when a rebuild started after that
+    has finished.
+    """
+
+    def __init__(self, rebuild, keep=JOBS_KEEP):
+        # rebuild() asks the scheduler for one forced rebuild
+        self.rebuild = rebuild
+        self.keep = keep
+        self.lock = threading.Lock()
+        self.jobs = OrderedDict()
+        # cert name -> entries waiting on its issuance
+        self.waiting = {}
+        # rebuilds started, as counted by the watcher
+        self.generation = 0
+
+    def create(self):
+        job = dict(
+            id=uuid.uuid4().hex,
+            state="queued",
+            created=time(),
+            finished=None,
+            entries=[],
+            # entries are still being added
+            sealed=False,
+            # a rebuild numbered above this serves the job's certificates
+            after=None,
+        )
+        with self.lock:
+            self.jobs[job["id"]] = job
+            self.expire()
+        return job
+
+    def expire(self):
+        finished = [
+            job_id
+            for job_id, job in self.jobs.items()
+            if job["state"] in ("done", "failed")
+        ]
+        for job_id in finished[: max(0, len(self.jobs) - self.keep)]:
+            del self.jobs[job_id]
+
+    def add(self, job, target, updated, cert_name):
+        entry = dict(
+            target=target,
+            updated=updated,
+            cert_name=cert_name,
+            state="issuing",
+            error=None,
+        )
+        with self.lock:
+            job["entries"].append(entry)
+            job["state"] = "issuing"
+            self.waiting.setdefault(cert_name, []).append((job, entry))
+        return entry
+
+    def seal(self, job):
+        """all entries are in; the job completes once they are through"""
+        with self.lock:
+            job["sealed"] = True
+            self.check(job)
+
+    def not_queued(self, job, entry, reason):
+        """issuance was never queued, so nothing will report back for it"""
+        with self.lock:
+            if entry["state"] != "issuing":
+                return
+            waiters = self.waiting.get(entry["cert_name"], [])
+            waiters.remove((job, entry))
+            if not waiters:
+                self.waiting.pop(entry["cert_name"], None)
+            self.finish(job, entry, False, reason)
+
+    def issued(self, keys, ready):
+        """a CertQueue job finished; True when some job was waiting on it"""
+        with self.lock:
+            waiters = []
+            for key in keys:
+                waiters += self.waiting.pop(key, [])
+            for job, entry in waiters:
+                self.finish(job, entry, ready, None if ready else "issuance failed")
+        return bool(waiters)
+
+    def finish(self, job, entry, ready, error):
+        # holding the lock
+        entry["state"] = "issued" if ready else "failed"
+        entry["error"] = error
+        self.check(job)
+
+    def check(self, job):
+        # holding the lock
+        entries = job["entries"]
+        if not job["sealed"] or any(e["state"] == "issuing" for e in entries):
+            return
+
+        if not any(e["state"] == "issued" for e in entries):
+            job["state"] = "failed"
+            job["finished"] = time()
+            return
+
+        job["state"] = "reloading"
+        job["after"] = self.generation
+        logger.info("cert job %s issued; requesting a reload" % (job["id"],))
+        self.rebuild()
+
+    def rebuilding(self):
+        """a rebuild starts; returns its generation"""
+        with self.lock:
+            self.generation += 1
+            return self.generation
+
+    def rebuilt(self, generation):
+        with self.lock:
+            for job in self.jobs.values():
+                if job["state"] == "reloading" and generation > job["after"]:
+                    job["state"] = "done"
+                    job["finished"] = time()
+
+    def describe(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return None
+            return dict(
+                id=job["id"],
+                state=job["state"],
+                created=job["created"],
+                finished=job["finished"],
+                entries=[dict(entry) for entry in job["entries"]],
+            )
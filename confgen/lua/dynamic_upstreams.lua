@@ -0,0 +1,145 @@
+----------------------------------------------
+-- dynamic upstream membership
+--
+-- The generator pushes every service's peers as one json document:
+--   { "foo.example.com": [ {"address": "172.18.0.5", "port": 80,
+--                           "weight": 1, "backup": false}, ... ] }
+-- It lands in the `upstreams` shared dict, either through the local
+-- admin endpoint (admin) or from the on-disk snapshot at (re)load (init).
+-- Workers decode it once per version and balance over the result, so
+-- container churn needs no nginx reload.
+
+local cjson = require "cjson.safe"
+local balancer = require "ngx.balancer"
+
+local _M = {}
+
+-- per worker: decoded peers and the shared dict version they came from
+local cached_version = nil
+local cached = {}
+
+
+local function store(body)
+  local upstreams = cjson.decode(body or "")
+  if type(upstreams) ~= "table" then
+    return nil, "body is not a json object"
+  end
+
+  local dict = ngx.shared.upstreams
+  local ok, err = dict:set("upstreams", body)
+  if not ok then
+    return nil, err
+  end
+  dict:incr("version", 1, 0)
+  return true
+end
+
+
+local function current()
+  local dict = ngx.shared.upstreams
+  local version = dict:get("version")
+  if version == cached_version then
+    return cached
+  end
+
+  local upstreams = cjson.decode(dict:get("upstreams") or "{}") or {}
+  local fresh = {}
+  for name, peers in pairs(upstreams) do
+    local primary, backup = {}, {}
+    local primaries, count = 0, 0
+    for _, peer in ipairs(peers) do
+      local pool = peer.backup and backup or primary
+      -- weight by repetition in the round-robin ring
+      for _ = 1, math.max(1, tonumber(peer.weight) or 1) do
+        pool[#pool + 1] = peer
+      end
+      count = count + 1
+      if not peer.backup then
+        primaries = primaries + 1
+      end
+    end
+    fresh[name] = {
+      primary = primary,
+      backup = backup,
+      primaries = primaries,
+      count = count,
+      next = 0,
+    }
+  end
+
+  cached = fresh
+  cached_version = version
+  return cached
+end
+
+
+function _M.init(snapshot)
+  local handle = io.open(snapshot, "r")
+  if not handle then
+    return
+  end
+  local body = handle:read("*a")
+  handle:close()
+
+  local ok, err = store(body)
+  if not ok then
+    ngx.log(ngx.ERR, "failed loading upstream snapshot ", snapshot, ": ", err)
+  end
+end
+
+
+function _M.admin()
+  local method = ngx.req.get_method()
+  if method == "GET" then
+    ngx.header["Content-Type"] = "application/json"
+    ngx.say(ngx.shared.upstreams:get("upstreams") or "{}")
+    return
+  end
+
+  if method ~= "POST" and method ~= "PUT" then
+    return ngx.exit(ngx.HTTP_NOT_ALLOWED)
+  end
+
+  ngx.req.read_body()
+  local ok, err = store(ngx.req.get_body_data())
+  if not ok then
+    ngx.status = ngx.HTTP_BAD_REQUEST
+    ngx.say(err)
+    return
+  end
+  ngx.say("ok")
+end
+
+
+function _M.balance(name)
+  local upstream = current()[name]
+  if not upstream or upstream.count == 0 then
+    -- no status may be sent from this phase; ERROR aborts the request
+    ngx.log(ngx.ERR, "no peers known for upstream ", name)
+    return ngx.exit(ngx.ERROR)
+  end
+
+  local ctx = ngx.ctx
+  local tries = (ctx.upstream_tries or 0) + 1
+  ctx.upstream_tries = tries
+  if tries == 1 and upstream.count > 1 then
+    balancer.set_more_tries(upstream.count - 1)
+  end
+
+  -- primaries first; backups once every primary had its turn
+  local pool = upstream.primary
+  if #pool == 0 or (tries > upstream.primaries and #upstream.backup > 0) then
+    pool = upstream.backup
+  end
+
+  upstream.next = upstream.next % #pool + 1
+  local peer = pool[upstream.next]
+  local ok, err = balancer.set_current_peer(peer.address, tonumber(peer.port))
+  if not ok then
+    ngx.log(ngx.ERR, "failed to set peer for ", name, ": ", err)
+    return ngx.exit(ngx.ERROR)
+  end
+end
+
+
+return _M
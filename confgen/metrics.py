@@ -0,0 +1,175 @@
+from itertools import chain, islice
+from time import time
+
+from prometheus_client import (
+    CollectorRegistry,
+    Counter,
+    Histogram,
+    generate_latest,
+)
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+# served by the listener's /metrics, fetched over the control socket
+registry = CollectorRegistry()
+
+REBUILD_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+CALL_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+rebuild_seconds = Histogram(
+    "confgen_rebuild_seconds",
+    "Duration of whole rebuilds",
+    buckets=REBUILD_BUCKETS,
+    registry=registry,
+)
+rebuild_phase_seconds = Histogram(
+    "confgen_rebuild_phase_seconds",
+    "Time each rebuild spent per phase: list, qualify, render, tidy, write",
+    ["phase"],
+    buckets=REBUILD_BUCKETS,
+    registry=registry,
+)
+docker_call_seconds = Histogram(
+    "confgen_docker_call_seconds",
+    "Docker API calls by kind",
+    ["call"],
+    buckets=CALL_BUCKETS,
+    registry=registry,
+)
+docker_errors = Counter(
+    "confgen_docker_errors_total",
+    "Docker API calls that failed",
+    ["call"],
+    registry=registry,
+)
+docker_events = Counter(
+    "confgen_docker_events_total",
+    "Container events received",
+    ["status"],
+    registry=registry,
+)
+vault_call_seconds = Histogram(
+    "confgen_vault_call_seconds",
+    "Vault approle logins and certificate issues",
+    ["call"],
+    buckets=CALL_BUCKETS,
+    registry=registry,
+)
+vault_errors = Counter(
+    "confgen_vault_errors_total",
+    "Vault calls that failed; unavailable ones consumed nothing",
+    ["call", "reason"],
+    registry=registry,
+)
+certificates = Counter(
+    "confgen_certificates_total",
+    "Certificate issuances by outcome",
+    ["result"],
+    registry=registry,
+)
+
+
+def timed(iterable, timings, key, batch=256):
+    """iterate, adding the time spent producing the items to timings[key]
+
+    Items are pulled a batch at a time, so the clock is read per batch
+    rather than per item.
+    """
+    iterator = iter(iterable)
+
+    def batches():
+        while True:
+            started = time()
+            items = list(islice(iterator, batch))
+            timings[key] += time() - started
+            if not items:
+                return
+            yield items
+
+    return chain.from_iterable(batches())
+
+
+class WatcherCollector:
+    """gauges and counters read from Watcher.stats() at scrape time"""
+
+    def __init__(self, stats):
+        self.stats = stats
+
+    def describe(self):
+        # nothing to check against other collectors up front
+        return []
+
+    def collect(self):
+        stats = self.stats()
+        scheduler = stats["scheduler"]
+        reloads = stats["reloads"]
+        vault = stats["vault"]
+
+        yield gauge(
+            "confgen_services", "Services in the last config", stats["config"]["services"]
+        )
+        yield gauge(
+            "confgen_upstreams",
+            "Containers serving in the last config",
+            stats["config"]["upstreams"],
+        )
+        yield gauge(
+            "confgen_containers_cached",
+            "Running containers known to the watcher",
+            stats["containers"]["cached"],
+        )
+        yield gauge(
+            "confgen_cert_queue_depth",
+            "Certificate issuances queued or running",
+            stats["certs"]["queue_depth"],
+        )
+        yield gauge(
+            "confgen_rebuild_queue_depth",
+            "Rebuild requests waiting to coalesce",
+            scheduler["queue_depth"],
+        )
+        yield gauge(
+            "confgen_rebuild_coalescing_ratio",
+            "Rebuild requests per rebuild",
+            scheduler["coalescing_ratio"],
+        )
+        yield counter(
+            "confgen_rebuild_requests", "Rebuilds asked for", scheduler["requests"]
+        )
+        yield counter("confgen_rebuilds", "Rebuilds run", scheduler["rebuilds"])
+        yield counter("confgen_reloads", "Reloads sent to nginx", reloads["reloads"])
+        yield counter(
+            "confgen_reloads_rejected",
+            "Configs nginx refused, rolled back",
+            reloads["rejected"],
+        )
+        if reloads["last_reload_at"]:
+            yield gauge(
+                "confgen_seconds_since_reload",
+                "Time since nginx was last reloaded",
+                time() - reloads["last_reload_at"],
+            )
+        yield gauge(
+            "confgen_vault_breaker_open",
+            "1 while vault calls are being refused by the circuit breaker",
+            0 if vault["breaker"] == "closed" else 1,
+        )
+        yield counter(
+            "confgen_vault_token_cache_hits", "Approle tokens reused", vault["hits"]
+        )
+
+
+def gauge(name, documentation, value):
+    family = GaugeMetricFamily(name, documentation)
+    family.add_metric([], value)
+    return family
+
+
+def counter(name, documentation, value):
+    family = CounterMetricFamily(name, documentation)
+    family.add_metric([], value)
+    return family
+
+
+def exposition():
+    """every metric, in the prometheus text format"""
+    return generate_latest(registry).decode("utf-8")
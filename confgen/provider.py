@@ -0,0 +1,166 @@
+import threading
+from time import time
+
+import docker
+
+import tracing
+from . import logger
+from container import Container
+from metrics import docker_call_seconds, docker_errors
+
+# what a /cert request may name its container by, in order of preference
+LOOKUP_FIELDS = [
+    ("domain", "service_fqdn"),
+    ("virtual_host", "service_fqdn"),
+    ("cert_name", "cert_name"),
+    ("container_name", "name"),
+    ("image", "image"),
+]
+
+
+class ContainerProvider:
+    """running containers, each inspected once and then patched from events
+
+    Listing is sparse (no inspect per container); only ids that are new or
+    whose listed state changed get inspected again, and each inspect result
+    is parsed into a Container record once.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.lock = threading.Lock()
+        # id -> (state key from the sparse listing, parsed Container)
+        self.cache = None
+        # (attribute, value) -> container or slot view; rebuilt after changes
+        self.index = None
+        self.counters = dict(lists=0, inspects=0, evictions=0)
+
+    @staticmethod
+    def state_key(attrs):
+        networks = (attrs.get("NetworkSettings") or {}).get("Networks") or {}
+        return (
+            attrs.get("Created"),
+            attrs.get("State"),
+            tuple(
+                sorted((name, net.get("IPAddress")) for name, net in networks.items())
+            ),
+        )
+
+    def count(self, counter, n=1):
+        with self.lock:
+            self.counters[counter] += n
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats["cached"] = len(self.cache or {})
+        return stats
+
+    def inspect(self, container_id):
+        self.count("inspects")
+        started = time()
+        try:
+            with docker_call_seconds.labels("inspect").time():
+                return self.client.containers.get(container_id)
+        except docker.errors.NotFound:
+            return None
+        except Exception:
+            docker_errors.labels("inspect").inc()
+            raise
+        finally:
+            tracing.add("docker.inspect", time() - started)
+
+    def refresh(self):
+        started = time()
+        try:
+            with docker_call_seconds.labels("list").time():
+                listed = self.client.containers.list(sparse=True)
+        except Exception:
+            docker_errors.labels("list").inc()
+            raise
+        tracing.add("docker.list", time() - started)
+        self.count("lists")
+        with self.lock:
+            known = dict(self.cache or {})
+
+        fresh = {}
+        inspected = 0
+        for sparse in listed:
+            key = ContainerProvider.state_key(sparse.attrs)
+            cached = known.get(sparse.id)
+            if cached and cached[0] == key:
+                fresh[sparse.id] = cached
+                continue
+
+            container = self.inspect(sparse.id)
+            inspected += 1
+            if container is not None:
+                started = time()
+                fresh[sparse.id] = (key, Container(container))
+                tracing.add("parse", time() - started)
+
+        with self.lock:
+            self.cache = fresh
+            self.index = None
+        logger.info(
+            "containers = %d; inspected = %d" % (len(fresh), inspected)
+        )
+
+    def containers(self):
+        if self.cache is None:
+            self.refresh()
+        with self.lock:
+            return [container for _key, container in self.cache.values()]
+
+    def update(self, container_id):
+        """inspect one container after an event; keep it only while running"""
+        if self.cache is None:
+            return
+        container = self.inspect(container_id)
+        if container is not None and container.status == "running":
+            container = Container(container)
+        else:
+            container = None
+        with self.lock:
+            if container is not None:
+                # no listing key; the next refresh inspects it once more
+                self.cache[container_id] = (None, container)
+            else:
+                self.cache.pop(container_id, None)
+            self.index = None
+
+    def evict(self, container_id):
+        if self.cache is None:
+            return
+        with self.lock:
+            if self.cache.pop(container_id, None) is not None:
+                self.counters["evictions"] += 1
+                self.index = None
+
+    def build_index(self):
+        index = {}
+        attrs = set(attr for _field, attr in LOOKUP_FIELDS)
+        for _key, container in self.cache.values():
+            views = [container] + [view for _ns, view in container.variants()]
+            for view in views:
+                for attr in attrs:
+                    value = getattr(view, attr, None)
+                    if value:
+                        index.setdefault((attr, value), view)
+        return index
+
+    def lookup(self, payload):
+        """the container a request names, by any of the LOOKUP_FIELDS"""
+        if self.cache is None:
+            self.refresh()
+        with self.lock:
+            if self.index is None:
+                self.index = self.build_index()
+            index = self.index
+
+        for field, attr in LOOKUP_FIELDS:
+            if payload.get(field):
+                container = index.get((attr, payload[field]))
+                logger.debug(" [%s] %s : %s", field, payload[field], bool(container))
+                if container is not None:
+                    return container
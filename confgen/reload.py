@@ -0,0 +1,196 @@
+import os
+import shlex
+import signal
+import subprocess
+import threading
+from time import sleep, time
+
+from . import environ, logger, CONF_DIR
+
+# written by nginx itself, as set in nginx_conf.tpl
+PID_FILE = environ("NGINX_PID_FILE", "/run/nginx.pid")
+# the main conf nginx runs with, rendered by start.sh
+NGINX_CONF = environ("NGINX_CONF", "/usr/local/openresty/nginx/conf/nginx.conf")
+# run with -c against the staged confs before they are promoted
+TEST_COMMAND = environ("NGINX_TEST_COMMAND", "openresty -t -q")
+# at most one reload per this many seconds; the rest wait and coalesce
+RELOAD_MIN_INTERVAL = float(environ("RELOAD_MIN_INTERVAL", 5))
+# how long to wait for a reload's new workers to show up
+RELOAD_WAIT = 10
+
+
+def read_pid(pid_file=PID_FILE):
+    with open(pid_file, "r") as handle:
+        return int(handle.read().strip())
+
+
+def children(pid):
+    """pids whose parent is pid, from /proc"""
+    found = set()
+    for name in os.listdir("/proc"):
+        if not name.isdigit():
+            continue
+        try:
+            with open("/proc/%s/stat" % (name,), "r") as stat:
+                # "pid (comm) state ppid ..."; comm may hold spaces or parens
+                fields = stat.read().rsplit(")", 1)[1].split()
+        except (IOError, OSError, IndexError):
+            continue
+        if int(fields[1]) == pid:
+            found.add(int(name))
+    return found
+
+
+def alive(pid):
+    return os.path.exists("/proc/%d" % (pid,))
+
+
+def staged_main_conf(stage_dir, main_conf=NGINX_CONF):
+    """a copy of main_conf including from stage_dir in place of CONF_DIR
+
+    Written beside main_conf, so its relative includes (mime.types) resolve
+    against the same conf prefix as they do for the running nginx.
+    """
+    directory, name = os.path.split(main_conf)
+    staged_conf = os.path.join(directory, ".staged." + name)
+    with open(main_conf, "r") as conf:
+        contents = conf.read()
+    with open(staged_conf, "w") as conf:
+        conf.write(contents.replace(CONF_DIR + "/", stage_dir + "/"))
+    return staged_conf
+
+
+class ReloadController:
+    """validates staged configs and SIGHUPs nginx, at a bounded rate
+
+    Reloads asked for within min_interval of the last one are held back and
+    coalesce into one, sent when the interval is up.
+    """
+
+    def __init__(self, min_interval=RELOAD_MIN_INTERVAL, pid_file=PID_FILE):
+        self.min_interval = min_interval
+        self.pid_file = pid_file
+        self.lock = threading.Lock()
+        # held while validated confs are moved into CONF_DIR and while a
+        # SIGHUP is sent, so nginx never loads a half-promoted tree
+        self.conf_lock = threading.Lock()
+        self.last_reload = None
+        # (reason, done) of the requests held back, if any
+        self.pending = None
+        # worker pids started by each reload; old ones linger while draining
+        self.generations = []
+        self.counters = dict(
+            requests=0,
+            reloads=0,
+            coalesced=0,
+            rejected=0,
+            failed=0,
+            last_duration=0.0,
+            max_duration=0.0,
+            last_reload_at=None,
+        )
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats["pending"] = self.pending is not None
+            stats["worker_generations"] = len(self.live_generations())
+        return stats
+
+    def validate(self, stage_dir):
+        """True when nginx accepts the confs laid out under stage_dir"""
+        try:
+            command = shlex.split(TEST_COMMAND)
+            command += ["-c", staged_main_conf(stage_dir)]
+            subprocess.check_output(command, stderr=subprocess.STDOUT)
+            return True
+        except subprocess.CalledProcessError as e:
+            logger.error("config rejected by nginx:\n%s" % (e.output,))
+        except (IOError, OSError) as e:
+            logger.error("could not run %s: %s" % (TEST_COMMAND, e))
+        with self.lock:
+            self.counters["rejected"] += 1
+        return False
+
+    def request(self, reason=None, done=None):
+        """reload now, or once min_interval is up; done() runs after it is sent"""
+        with self.lock:
+            self.counters["requests"] += 1
+            if self.pending is not None:
+                self.pending.append((reason, done))
+                self.counters["coalesced"] += 1
+                return
+            wait = 0
+            if self.last_reload is not None:
+                wait = self.last_reload + self.min_interval - time()
+            if wait > 0:
+                self.pending = [(reason, done)]
+                timer = threading.Timer(wait, self.release)
+                timer.daemon = True
+                timer.start()
+                logger.info("reload held back %.1fs: %s" % (wait, reason))
+                return
+            self.last_reload = time()
+
+        self.reload(reason)
+        if done:
+            done()
+
+    def release(self):
+        with self.lock:
+            pending = self.pending or []
+            self.pending = None
+            self.last_reload = time()
+
+        self.reload("; ".join(reason for reason, _done in pending if reason) or None)
+        for _reason, done in pending:
+            if done:
+                try:
+                    done()
+                except Exception as e:
+                    logger.exception(e)
+
+    def reload(self, reason=None):
+        logger.info("Cycle frontend: %s" % (reason or "unspecified",))
+        started = time()
+        # no conf is promoted while the SIGHUP is being sent
+        with self.conf_lock:
+            try:
+                pid = read_pid(self.pid_file)
+                before = children(pid)
+                os.kill(pid, signal.SIGHUP)
+                logger.info("Sent SIGHUP to pid %d" % (pid,))
+            except Exception as e:
+                with self.lock:
+                    self.counters["failed"] += 1
+                logger.exception(e)
+                return False
+
+        # done once the master has forked a worker of the new generation
+        workers = set()
+        while time() - started < RELOAD_WAIT:
+            workers = children(pid) - before
+            if workers:
+                break
+            sleep(0.05)
+        duration = time() - started
+
+        with self.lock:
+            if not self.generations and before:
+                # the workers nginx started with
+                self.generations.append(before)
+            self.counters["reloads"] += 1
+            self.counters["last_reload_at"] = started
+            self.counters["last_duration"] = duration
+            self.counters["max_duration"] = max(duration, self.counters["max_duration"])
+            if workers:
+                self.generations.append(workers)
+            self.generations = self.live_generations()
+        logger.info(
+            "reload took %.2fs; %d worker generations alive"
+            % (duration, len(self.generations))
+        )
+        return True
+
+    def live_generations(self):
+        return [g for g in self.generations if any(alive(pid) for pid in g)]
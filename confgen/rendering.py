@@ -0,0 +1,66 @@
+import hashlib
+import os
+import threading
+
+from jinja2 import (
+    Environment,
+    FileSystemBytecodeCache,
+    PackageLoader,
+    select_autoescape,
+)
+
+from . import environ, logger
+
+# compiled templates, kept across restarts of the watcher
+TEMPLATE_CACHE_DIR = environ("TEMPLATE_CACHE_DIR", "/var/cache/confgen")
+CUSTOM_TEMPLATES_KEEP = 512
+
+
+def bytecode_cache(directory=TEMPLATE_CACHE_DIR):
+    try:
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        return FileSystemBytecodeCache(directory)
+    except OSError as e:
+        logger.warning("no template bytecode cache: %s" % (e,))
+        return None
+
+
+_bytecode_cache = bytecode_cache()
+
+# the packaged templates, conf.tpl and its includes
+templates = Environment(
+    loader=PackageLoader("confgen", "templates"),
+    autoescape=select_autoescape(["tpl"]),
+    bytecode_cache=_bytecode_cache,
+)
+
+# custom confs dropped in per service; rendered without autoescaping, as always
+custom_templates = Environment(bytecode_cache=_bytecode_cache)
+_custom_lock = threading.Lock()
+_custom_compiled = {}
+
+
+def prewarm():
+    """compile every packaged template once, up front"""
+    for name in templates.list_templates():
+        templates.get_template(name)
+    logger.debug("templates compiled: %d" % (len(templates.list_templates()),))
+
+
+def custom_template(source):
+    """a compiled custom conf, memoized by the hash of its source"""
+    data = source if isinstance(source, bytes) else source.encode("utf-8")
+    key = hashlib.sha1(data).hexdigest()
+    with _custom_lock:
+        template = _custom_compiled.get(key)
+    if template is not None:
+        return template
+
+    template = custom_templates.from_string(source)
+    with _custom_lock:
+        if len(_custom_compiled) >= CUSTOM_TEMPLATES_KEEP:
+            # confs that were edited away leave stale entries behind
+            _custom_compiled.clear()
+        _custom_compiled[key] = template
+    return template
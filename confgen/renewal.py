@@ -0,0 +1,59 @@
+import random
+import threading
+from time import sleep, time
+
+from . import environ, logger
+
+# renew this long before notAfter, plus up to RENEW_JITTER earlier per cert
+RENEW_BEFORE = int(environ("CERT_RENEW_BEFORE", 14 * 86400))
+RENEW_JITTER = int(environ("CERT_RENEW_JITTER", 3 * 86400))
+RENEW_INTERVAL = int(environ("CERT_RENEW_INTERVAL", 3600))
+
+
+class CertRenewer:
+    """renews certs from the index ahead of expiry, spread out by jitter"""
+
+    def __init__(self, index, renew):
+        self.index = index
+        # renew(cert_name) -> bool; False when no running service uses the cert
+        self.renew = renew
+        self.offsets = {}
+        self.thread = None
+
+    def start(self):
+        if self.thread:
+            return
+        self.thread = threading.Thread(target=self.run, name="cert-renewer")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        while True:
+            # first pass after a rebuild has recorded which service owns what
+            sleep(RENEW_INTERVAL)
+            try:
+                self.check()
+            except Exception as e:
+                logger.exception(e)
+
+    def renew_at(self, cert):
+        if cert["name"] not in self.offsets:
+            self.offsets[cert["name"]] = random.uniform(0, RENEW_JITTER)
+        return cert["not_after"] - RENEW_BEFORE - self.offsets[cert["name"]]
+
+    def check(self, now=None):
+        now = now or time()
+        due = [
+            cert
+            for cert in self.index.all()
+            if cert["not_after"] and self.renew_at(cert) <= now
+        ]
+        for cert in sorted(due, key=lambda c: c["not_after"]):
+            days = (cert["not_after"] - now) / 86400.0
+            logger.info("cert %s expires in %.1f days; renewing" % (cert["name"], days))
+            if not self.renew(cert["name"]):
+                logger.warning(
+                    "cert %s is due for renewal, but no running service uses it"
+                    % (cert["name"],)
+                )
+        return due
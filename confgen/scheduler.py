@@ -0,0 +1,140 @@
+import threading
+from time import time
+
+from . import environ, logger
+
+# no event waits longer than this for its rebuild, however busy the stream
+MAX_LATENCY = float(environ("REBUILD_MAX_LATENCY", 10))
+# trailing debounce for urgent events, e.g. a serving container died
+URGENT_DEBOUNCE = float(environ("REBUILD_URGENT_DEBOUNCE", 0.1))
+
+
+class RebuildScheduler:
+    """runs one rebuild at a time; requests made meanwhile coalesce into one more
+
+    A rebuild starts once requests have been quiet for the debounce, or
+    max_latency after the first of them, whichever is sooner.
+    """
+
+    def __init__(
+        self,
+        rebuild,
+        debounce,
+        max_latency=MAX_LATENCY,
+        urgent_debounce=URGENT_DEBOUNCE,
+    ):
+        # rebuild(force, fqdns) does the work, on the scheduler's thread; fqdns
+        # names the only services that changed, or is None for a full rebuild
+        self.rebuild = rebuild
+        self.debounce = debounce
+        self.max_latency = max(debounce, max_latency)
+        self.urgent_debounce = urgent_debounce
+        self.cond = threading.Condition()
+        self.thread = None
+
+        # the pending rebuild
+        self.first_request = None
+        self.last_request = None
+        self.urgent = False
+        self.force = False
+        self.depth = 0
+        # services named by targeted requests, unless a full one came in too
+        self.full = False
+        self.fqdns = set()
+
+        self.counters = dict(
+            requests=0,
+            urgent=0,
+            rebuilds=0,
+            queue_depth=0,
+            last_delay=0.0,
+            max_delay=0.0,
+            running=False,
+        )
+
+    def start(self):
+        with self.cond:
+            if self.thread:
+                return
+            self.thread = threading.Thread(target=self.run, name="rebuilds")
+            self.thread.daemon = True
+            self.thread.start()
+
+    def request(self, urgent=False, force=False, fqdns=None):
+        """ask for a rebuild; with fqdns, only those services have changed"""
+        with self.cond:
+            now = time()
+            if self.first_request is None:
+                self.first_request = now
+            self.last_request = now
+            self.urgent = self.urgent or urgent
+            self.force = self.force or force
+            if fqdns is None:
+                self.full = True
+            else:
+                self.fqdns.update(fqdns)
+            self.depth += 1
+            self.counters["requests"] += 1
+            self.counters["urgent"] += 1 if urgent else 0
+            self.counters["queue_depth"] = self.depth
+            self.cond.notify()
+        self.start()
+
+    def stats(self):
+        with self.cond:
+            stats = dict(self.counters)
+        # requests per rebuild; higher means more events were coalesced
+        stats["coalescing_ratio"] = stats["requests"] / float(
+            max(1, stats["rebuilds"])
+        )
+        return stats
+
+    def due(self):
+        debounce = self.urgent_debounce if self.urgent else self.debounce
+        return min(
+            self.last_request + debounce, self.first_request + self.max_latency
+        )
+
+    def next_rebuild(self):
+        with self.cond:
+            while True:
+                if self.first_request is None:
+                    self.cond.wait()
+                    continue
+                remaining = self.due() - time()
+                if remaining <= 0:
+                    break
+                self.cond.wait(remaining)
+
+            pending = (
+                self.force,
+                None if self.full else self.fqdns,
+                self.depth,
+                time() - self.first_request,
+            )
+            self.first_request = self.last_request = None
+            self.urgent = self.force = self.full = False
+            self.fqdns = set()
+            self.depth = 0
+            self.counters["queue_depth"] = 0
+            self.counters["running"] = True
+        return pending
+
+    def run(self):
+        while True:
+            force, fqdns, depth, delay = self.next_rebuild()
+            logger.debug(
+                "rebuild after %.2fs; %d requests coalesced" % (delay, depth)
+            )
+            try:
+                self.rebuild(force, fqdns)
+            except Exception as e:
+                logger.exception(e)
+            finally:
+                with self.cond:
+                    self.counters["running"] = False
+                    self.counters["rebuilds"] += 1
+                    self.counters["last_delay"] = delay
+                    self.counters["max_delay"] = max(
+                        delay, self.counters["max_delay"]
+                    )
@@ -1,33 +1,31 @@
-import os
+import hashlib
+import json
 
-from jinja2 import Environment
+from customconfs import CustomConfStore
+from rendering import custom_template
+from upstreams import DYNAMIC_UPSTREAMS
+from . import environ
 
-from . import CONF_DIR
-
-
-def list_custom_confs(service_fqdn):
-    custom_path = "/".join([CONF_DIR, service_fqdn])
-    custom_confs = []
-    if os.path.isdir(custom_path):
-        custom_confs = sorted(
-            [
-                open(os.path.join(dirpath, f), "r").read()
-                for dirpath, _dirnames, files in os.walk(custom_path)
-                for f in files
-            ]
-        )
-    return custom_confs
+# idle connections kept open to each service's containers, per nginx worker,
+# unless its containers label otherwise; 0 opens one per request
+UPSTREAM_KEEPALIVE = int(environ("UPSTREAM_KEEPALIVE", 0))
+# balancing methods that take no backup servers
+NO_BACKUP_LB = ("hash", "ip_hash", "random")
 
 
 class Service:
+    confs = CustomConfStore()
+
     def __init__(self, service_fqdn, upstream):
         self.containers = []
+        # ids of containers older than the newest; served as backup peers
+        self.backups = set()
         self.fqdn = service_fqdn
         self.upstream = upstream
         self.default_server = False
         self.serve_http = False
         self.proxy_pass = False
-        self.custom_confs = list_custom_confs(service_fqdn)
+        self.custom_confs = Service.confs.get(service_fqdn)
         # omit the default "location /" block  (label: openresty.skip_root_location=True)
         self.skip_root_location = False
         # run custom confs through jinja2  (label: openresty.render_confs=True)
@@ -36,8 +34,13 @@ class Service:
         self.auth_cert_bundle = None
         self.required_group = None
         self.max_upload_size = "20M"
+        # upstream block  (labels: openresty.upstream.lb=least_conn, .keepalive=16, ...)
+        self.lb = None
+        self.keepalive = UPSTREAM_KEEPALIVE or None
+        self.keepalive_requests = None
+        self.keepalive_timeout = None
 
-    def add_container(self, container):
+    def add_container(self, container, demoted=False):
         copy_keys = [
             "default_server",
             "proxy_pass",
@@ -51,9 +54,13 @@ class Service:
         ]
 
         for k in copy_keys:
+            if demoted and k == "default_server":
+                continue
             val = getattr(container, k, None)
             if val:
                 setattr(self, k, val)
+        for k, val in container.upstream_conf.items():
+            setattr(self, k, val)
         self.containers.append(container)
 
     @staticmethod
@@ -64,18 +71,65 @@ class Service:
             if latest_date is None or d > latest_date:
                 latest_date = d
 
-        for container in service.containers:
-            if container.created_date() != latest_date:
-                container.options = "backup"
-
+        service.backups = set(
+            container.id
+            for container in service.containers
+            if container.created_date() != latest_date
+        )
         return service
 
+    def peer_options(self, container):
+        if container.id in self.backups:
+            # older containers serve alongside the newest where backups can't
+            if self.lb_method and self.lb_method.split()[0] in NO_BACKUP_LB:
+                return container.options
+            return "backup"
+        return container.options
+
+    @property
+    def lb_method(self):
+        """the balancing directive; dynamic upstreams balance in lua instead"""
+        if DYNAMIC_UPSTREAMS:
+            return None
+        return self.lb
+
     def server_names(self):
-        names = {self.fqdn}
+        names = set()
         for container in self.containers:
             if container.nginx_use_other_names and container.other_names:
                 names = names.union(set(container.other_names))
-        return " ".join(names)
+        names.discard(self.fqdn)
+        # stable order, so identical inputs render identical confs
+        return " ".join([self.fqdn] + sorted(names))
+
+    def fingerprint(self, include_peers=True):
+        """digest of everything service.tpl renders from this service"""
+        facts = dict(
+            fqdn=self.fqdn,
+            upstream=self.upstream,
+            default_server=self.default_server,
+            serve_http=self.serve_http,
+            proxy_pass=self.proxy_pass,
+            skip_root_location=self.skip_root_location,
+            render_confs=self.render_confs,
+            auth_basic_file=self.auth_basic_file,
+            auth_cert_bundle=self.auth_cert_bundle,
+            required_group=self.required_group,
+            max_upload_size=self.max_upload_size,
+            lb=self.lb_method,
+            keepalive=[self.keepalive, self.keepalive_requests, self.keepalive_timeout],
+            cert_name=self.cert_name,
+            server_names=self.server_names(),
+            custom_confs=Service.confs.digest(self.fqdn),
+        )
+        if include_peers:
+            facts["peers"] = [
+                [c.ip_address, c.exposed_port, self.peer_options(c)]
+                for c in self.containers
+            ]
+        return hashlib.sha1(
+            json.dumps(facts, sort_keys=True).encode("utf-8")
+        ).hexdigest()
 
     @property
     def cert_name(self):
@@ -89,6 +143,6 @@ class Service:
     @property
     def rendered_custom_confs(self):
         return [
-            Environment().from_string(conf).render(service=self)
+            custom_template(conf).render(service=self)
             for conf in self.custom_confs
         ]
@@ -1,6 +1,7 @@
+# no Connection header unless upgrading, so upstream keepalive pools are reused
 map $http_upgrade $proxy_connection {
   default upgrade;
-  '' close;
+  '' '';
 }
 
 map $http_x_forwarded_proto $proxy_x_forwarded_proto {
@@ -10,6 +11,14 @@ map $http_x_forwarded_proto $proxy_x_forwarded_proto {
 
 lua_shared_dict cache 20m;
 
+{% if dynamic.enabled %}
+lua_shared_dict upstreams 10m;
+lua_package_path "{{ dynamic.lua_dir }}/?.lua;;";
+init_by_lua_block {
+    require("dynamic_upstreams").init("{{ dynamic.snapshot }}")
+}
+{% endif %}
+
 # HTTP 1.1 support
 proxy_http_version 1.1;
 proxy_buffering off;
@@ -28,7 +37,26 @@ server {
 	return 503;
 }
 
+{% if dynamic.enabled %}
+server {
+	listen 127.0.0.1:{{ dynamic.admin_port }};
+	access_log off;
+	client_max_body_size 10m;
+	client_body_buffer_size 10m;
+
+	location = /upstreams {
+		content_by_lua_block {
+			require("dynamic_upstreams").admin()
+		}
+	}
+}
+{% endif %}
+
 
+{% if services_dir %}
+include {{ services_dir }}/*.conf;
+{% else %}
 {% for service in services %}
 {% include "service.tpl" %}
 {% endfor %}
+{% endif %}
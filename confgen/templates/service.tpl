@@ -2,8 +2,29 @@
 ## {{service.fqdn}}
 ########
 upstream {{service.fqdn}} {
+    {% if dynamic.enabled %}
+    # placeholder; peers come from the upstreams shared dict
+    server 0.0.0.1;
+    balancer_by_lua_block {
+        require("dynamic_upstreams").balance("{{service.upstream}}")
+    }
+    {% else %}
+    {% if service.lb_method %}
+    {{service.lb_method}};
+    {% endif %}
     {% for container in service.containers %}
-    server {{container.ip_address}}:{{container.exposed_port}}{% if container.options %} {{container.options}}{% endif %};{% endfor %}
+    server {{container.ip_address}}:{{container.exposed_port}}{% if service.peer_options(container) %} {{service.peer_options(container)}}{% endif %};{% endfor %}
+    {% endif %}
+    {% if service.keepalive %}
+    {# after the balancing method, which it wraps #}
+    keepalive {{service.keepalive}};
+    {% if service.keepalive_requests %}
+    keepalive_requests {{service.keepalive_requests}};
+    {% endif %}
+    {% if service.keepalive_timeout %}
+    keepalive_timeout {{service.keepalive_timeout}};
+    {% endif %}
+    {% endif %}
 }
 
 {% include "http.tpl" %}
@@ -0,0 +1,178 @@
+import cProfile
+import json
+import os
+import signal
+import threading
+from contextlib import contextmanager
+from time import time
+
+from . import environ, logger, truthy
+
+# one JSON log record per rebuild, on the confgen.trace logger
+TRACE_REBUILDS = truthy(environ("TRACE_REBUILDS", 1))
+# services listed by qualification cost in each record, slowest first
+TRACE_SLOWEST = int(environ("TRACE_SLOWEST_SERVICES", 20))
+# rebuilds to profile from startup, and per SIGUSR1
+PROFILE_REBUILDS = int(environ("PROFILE_REBUILDS", 0))
+PROFILE_ON_SIGNAL = int(environ("PROFILE_ON_SIGNAL", 3))
+PROFILE_DIR = environ("PROFILE_DIR", "/tmp")
+
+trace_logger = logger.getChild("trace")
+_local = threading.local()
+
+
+class Trace:
+    """nested spans, totals and per-service costs of one rebuild"""
+
+    def __init__(self):
+        self.started = time()
+        self.root = dict(name="rebuild", children=[])
+        self.stack = [self.root]
+        # name -> [count, seconds], for work done many times or off the stack
+        self.totals = {}
+        # service fqdn -> seconds spent qualifying its containers
+        self.costs = {}
+        self.fields = {}
+
+    @contextmanager
+    def span(self, name):
+        node = dict(name=name, children=[])
+        self.stack[-1]["children"].append(node)
+        self.stack.append(node)
+        started = time()
+        try:
+            yield node
+        finally:
+            node["seconds"] = round(time() - started, 6)
+            self.stack.pop()
+
+    def add(self, name, seconds, count=1):
+        total = self.totals.setdefault(name, [0, 0.0])
+        total[0] += count
+        total[1] += seconds
+
+    def cost(self, fqdn, seconds):
+        self.costs[fqdn] = self.costs.get(fqdn, 0.0) + seconds
+
+    def record(self):
+        slowest = sorted(self.costs.items(), key=lambda item: -item[1])
+        record = dict(
+            event="rebuild",
+            seconds=round(time() - self.started, 6),
+            spans=[compact(node) for node in self.root["children"]],
+            totals=dict(
+                (name, dict(count=count, seconds=round(seconds, 6)))
+                for name, (count, seconds) in self.totals.items()
+            ),
+            services=dict(
+                count=len(self.costs),
+                slowest=[
+                    dict(fqdn=fqdn, seconds=round(seconds, 6))
+                    for fqdn, seconds in slowest[:TRACE_SLOWEST]
+                ],
+            ),
+        )
+        record.update(self.fields)
+        return record
+
+
+def compact(node):
+    compacted = dict(name=node["name"], seconds=node.get("seconds"))
+    if node["children"]:
+        compacted["children"] = [compact(child) for child in node["children"]]
+    return compacted
+
+
+def current():
+    """the trace of the rebuild running on this thread, if any"""
+    return getattr(_local, "trace", None)
+
+
+@contextmanager
+def span(name):
+    trace = current()
+    if trace is None:
+        yield None
+        return
+    with trace.span(name) as node:
+        yield node
+
+
+def add(name, seconds, count=1):
+    trace = current()
+    if trace is not None:
+        trace.add(name, seconds, count=count)
+
+
+def annotate(**fields):
+    trace = current()
+    if trace is not None:
+        trace.fields.update(fields)
+
+
+@contextmanager
+def rebuild():
+    """trace (and maybe profile) the rebuild run inside; logged at the end"""
+    trace = Trace() if TRACE_REBUILDS else None
+    profile = profiler.start()
+    _local.trace = trace
+    try:
+        yield trace
+    finally:
+        _local.trace = None
+        profiler.stop(profile)
+        if trace is not None:
+            trace_logger.info(json.dumps(trace.record(), sort_keys=True))
+
+
+class Profiler:
+    """cProfiles the next rebuilds it is armed for, one file each"""
+
+    def __init__(self, directory=PROFILE_DIR, rebuilds=PROFILE_REBUILDS):
+        self.directory = directory
+        # re-entrant: the signal handler may interrupt start() on its thread
+        self.lock = threading.RLock()
+        self.remaining = rebuilds
+        self.written = 0
+
+    def arm(self, rebuilds):
+        with self.lock:
+            self.remaining += rebuilds
+        logger.info("profiling the next %d rebuilds" % (rebuilds,))
+
+    def install(self, signum=signal.SIGUSR1, rebuilds=PROFILE_ON_SIGNAL):
+        try:
+            signal.signal(signum, lambda _signum, _frame: self.arm(rebuilds))
+        except ValueError:
+            logger.warning("not on the main thread; no profiling on signal")
+            return
+        # a blocking read of the event stream carries on instead of failing
+        signal.siginterrupt(signum, False)
+
+    def start(self):
+        with self.lock:
+            if self.remaining <= 0:
+                return None
+            self.remaining -= 1
+        profile = cProfile.Profile()
+        profile.enable()
+        return profile
+
+    def stop(self, profile):
+        if profile is None:
+            return
+        profile.disable()
+        with self.lock:
+            self.written += 1
+            written = self.written
+        path = os.path.join(
+            self.directory, "rebuild-%d-%d-%d.prof" % (int(time()), os.getpid(), written)
+        )
+        try:
+            profile.dump_stats(path)
+            logger.info("rebuild profile written: %s" % (path,))
+        except (IOError, OSError) as e:
+            logger.warning("could not write rebuild profile %s: %s" % (path, e))
+
+
+profiler = Profiler()
@@ -0,0 +1,82 @@
+import json
+import os
+
+import requests
+
+from . import environ, truthy, logger, CONF_DIR
+
+# peers go to a shared dict through a local admin endpoint instead of the conf
+DYNAMIC_UPSTREAMS = truthy(environ("DYNAMIC_UPSTREAMS", 0))
+UPSTREAM_ADMIN_PORT = int(environ("UPSTREAM_ADMIN_PORT", 44381))
+# loaded by init_by_lua on every (re)load; not a *.conf, so nginx skips it
+UPSTREAMS_FILE = CONF_DIR + "/upstreams.json"
+LUA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "lua")
+
+
+def peer(container, options):
+    options = (options or "").split()
+    weight = 1
+    for option in options:
+        if option.startswith("weight="):
+            try:
+                weight = int(option.split("=", 1)[1])
+            except ValueError:
+                pass
+
+    return dict(
+        address=container.ip_address,
+        port=int(container.exposed_port),
+        weight=weight,
+        backup="backup" in options,
+    )
+
+
+class UpstreamSync:
+    def __init__(self, admin_port=UPSTREAM_ADMIN_PORT):
+        self.admin_url = "http://127.0.0.1:%d/upstreams" % (admin_port,)
+        self.pushed = None
+
+    @staticmethod
+    def peers(services):
+        return dict(
+            (
+                service.upstream,
+                [peer(c, service.peer_options(c)) for c in service.containers],
+            )
+            for service in services
+        )
+
+    def sync(self, services):
+        """push peers to nginx; False when it needs a reload to pick them up"""
+        body = json.dumps(UpstreamSync.peers(services), sort_keys=True)
+        if body == self.pushed:
+            return True
+
+        with open(UPSTREAMS_FILE, "w") as snapshot:
+            snapshot.write(body)
+
+        try:
+            response = requests.post(self.admin_url, data=body, timeout=2)
+            pushed = response.status_code == 200
+            if not pushed:
+                logger.warning(
+                    "upstream push rejected: %d %s"
+                    % (response.status_code, response.text.strip())
+                )
+        except requests.RequestException as e:
+            logger.warning("upstream push failed: %s" % (e,))
+            pushed = False
+
+        if pushed:
+            logger.info("pushed peers for %d upstreams" % (len(services),))
+            self.pushed = body
+        return pushed
+
+    @staticmethod
+    def render_context():
+        return dict(
+            enabled=DYNAMIC_UPSTREAMS,
+            admin_port=UPSTREAM_ADMIN_PORT,
+            lua_dir=LUA_DIR,
+            snapshot=UPSTREAMS_FILE,
+        )
@@ -0,0 +1,301 @@
+import hashlib
+import logging
+import os
+import random
+import threading
+from time import sleep, time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+
+logger = logging.getLogger(__name__)
+env = os.environ.get
+
+# seconds any single vault request may take
+VAULT_TIMEOUT = float(env("VAULT_TIMEOUT", 10))
+# renew (or log in again) this long before a token's lease runs out
+TOKEN_RENEW_BUFFER = int(env("VAULT_TOKEN_RENEW_BUFFER", 60))
+VAULT_POOL_SIZE = int(env("VAULT_POOL_SIZE", env("CERT_WORKERS", 4)))
+
+# consecutive failures that open the breaker, and how long it first stays open
+BREAKER_THRESHOLD = int(env("VAULT_BREAKER_THRESHOLD", 5))
+BREAKER_BACKOFF = float(env("VAULT_BREAKER_BACKOFF", 5))
+BREAKER_BACKOFF_MAX = float(env("VAULT_BREAKER_BACKOFF_MAX", 300))
+# retries per request at most, and the share of requests that may be retried
+RETRY_MAX = int(env("VAULT_RETRIES", 2))
+RETRY_RATIO = float(env("VAULT_RETRY_RATIO", 0.2))
+RETRY_DELAY = 0.2
+# answers meaning vault did not handle the request
+UNAVAILABLE_STATUSES = (503,)
+# answers of a proxy in front of vault, which may have handled it all the same
+GATEWAY_STATUSES = (502, 504)
+
+
+class VaultUnavailable(Exception):
+    """vault was not reached, its answer was lost, or the breaker is open"""
+
+
+def not_sent(error):
+    """whether a request failed before any of it reached vault"""
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    if isinstance(error, requests.exceptions.ConnectionError):
+        # refused, or the name did not resolve; wrapped by urllib3's retries
+        reason = error.args[0] if error.args else None
+        return isinstance(getattr(reason, "reason", reason), NewConnectionError)
+    return False
+
+
+class CircuitBreaker:
+    def __init__(self, threshold=BREAKER_THRESHOLD, backoff=BREAKER_BACKOFF):
+        self.threshold = threshold
+        self.base_backoff = backoff
+        self.backoff = backoff
+        self.failures = 0
+        self.open_until = 0
+        self.state = "closed"
+        self.lock = threading.Lock()
+        # called with the seconds until a trial request is allowed
+        self.on_open = None
+
+    def allow(self):
+        with self.lock:
+            if self.state == "closed":
+                return True
+            if self.state == "open" and time() >= self.open_until:
+                # let one trial request through
+                self.state = "half_open"
+                return True
+            return False
+
+    def is_open(self):
+        with self.lock:
+            return self.state != "closed" and (
+                self.state == "half_open" or time() < self.open_until
+            )
+
+    def success(self):
+        with self.lock:
+            if self.state != "closed":
+                logger.info("vault circuit closed")
+            self.state = "closed"
+            self.failures = 0
+            self.backoff = self.base_backoff
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == "open":
+                return
+            if self.state == "closed" and self.failures < self.threshold:
+                return
+            self.state = "open"
+            delay = self.backoff
+            self.open_until = time() + delay
+            self.backoff = min(self.backoff * 2, BREAKER_BACKOFF_MAX)
+
+        logger.warning("vault circuit open for %.0fs" % (delay,))
+        if self.on_open:
+            self.on_open(delay)
+
+
+class RetryBudget:
+    """each request earns RETRY_RATIO of a retry; an outage can't multiply load"""
+
+    def __init__(self, ratio=RETRY_RATIO, cap=10):
+        self.ratio = ratio
+        self.cap = cap
+        self.tokens = float(cap)
+        self.lock = threading.Lock()
+
+    def deposit(self):
+        with self.lock:
+            self.tokens = min(self.cap, self.tokens + self.ratio)
+
+    def withdraw(self):
+        with self.lock:
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+class VaultClient:
+    """one keep-alive session and an approle token cache for every vault call"""
+
+    def __init__(self, pool_size=VAULT_POOL_SIZE):
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(1, pool_size))
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.verify = env("REQUESTS_CA_BUNDLE") or True
+
+        self.lock = threading.Lock()
+        # (role_id, digest of the secret_id) -> dict(token, expires, renewable);
+        # role ids are not secret, so a token is only reused with its secret
+        self.tokens = {}
+        # digest of a wrapping token -> the secret_id it held; unwrapping spends
+        # the token, so what it held is kept until a login with it is answered
+        self.unwrapped = {}
+        self.counters = dict(
+            hits=0, misses=0, renewals=0, logins=0, retries=0, rejected=0
+        )
+        self.breaker = CircuitBreaker()
+        self.budget = RetryBudget()
+
+    @staticmethod
+    def url(path):
+        return "%s/v1/%s" % (env("VAULT_ADDR"), path.lstrip("/"))
+
+    def post(self, url, payload=None, token=None, retry=True):
+        """json answer of vault; VaultUnavailable if it could not be had
+
+        Requests that never reached vault, and 503s, are retried. Other
+        failures (a dropped connection, a read timeout, a gateway's 502 or 504)
+        may follow vault handling the request, so they are only retried with
+        retry; calls that spend a secret or issue a certificate pass False.
+        """
+        headers = {"Content-Type": "application/json"}
+        if token:
+            headers["X-Vault-Token"] = token
+
+        self.budget.deposit()
+        attempt = 0
+        while True:
+            if not self.breaker.allow():
+                self.count("rejected")
+                raise VaultUnavailable("vault circuit is open")
+
+            try:
+                response = self.session.post(
+                    url, json=payload, headers=headers, timeout=VAULT_TIMEOUT
+                )
+            except requests.exceptions.RequestException as e:
+                error = e
+                retryable = retry or not_sent(e)
+            else:
+                status = response.status_code
+                if status not in UNAVAILABLE_STATUSES + GATEWAY_STATUSES:
+                    self.breaker.success()
+                    return response.json()
+                error = "HTTP %d" % (status,)
+                retryable = retry or status in UNAVAILABLE_STATUSES
+
+            self.breaker.failure()
+            attempt += 1
+            if not retryable or attempt > RETRY_MAX or not self.budget.withdraw():
+                raise VaultUnavailable("%s: %s" % (url, error))
+
+            self.count("retries")
+            sleep(RETRY_DELAY * 2 ** attempt * random.uniform(0.5, 1.5))
+
+    def count(self, counter):
+        with self.lock:
+            self.counters[counter] += 1
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats["cached_tokens"] = len(self.tokens)
+        stats["breaker"] = self.breaker.state
+        return stats
+
+    @staticmethod
+    def secret_digest(secret):
+        return hashlib.sha256(str(secret).encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def token_key(role_id, secret_id):
+        return role_id, VaultClient.secret_digest(secret_id)
+
+    def cached_token(self, role_id, secret_id):
+        key = VaultClient.token_key(role_id, secret_id)
+        with self.lock:
+            entry = self.tokens.get(key)
+
+        if entry and entry["expires"] - TOKEN_RENEW_BUFFER > time():
+            self.count("hits")
+            return entry["token"]
+
+        if entry and entry["renewable"]:
+            auth = self.renew(entry["token"])
+            if auth:
+                self.cache_token(role_id, secret_id, auth)
+                self.count("renewals")
+                self.count("hits")
+                return auth["client_token"]
+
+        with self.lock:
+            self.tokens.pop(key, None)
+        self.count("misses")
+        return None
+
+    def has_token(self, role_id, secret_id):
+        """whether cached_token() could answer without logging in"""
+        with self.lock:
+            entry = self.tokens.get(VaultClient.token_key(role_id, secret_id))
+        if not entry:
+            return False
+        return entry["renewable"] or entry["expires"] - TOKEN_RENEW_BUFFER > time()
+
+    def cache_token(self, role_id, secret_id, auth):
+        lease = int(auth.get("lease_duration") or 0)
+        entry = dict(
+            token=auth["client_token"],
+            # a zero lease never expires
+            expires=time() + lease if lease else float("inf"),
+            renewable=bool(auth.get("renewable")),
+        )
+        with self.lock:
+            self.tokens[VaultClient.token_key(role_id, secret_id)] = entry
+
+    def renew(self, token):
+        try:
+            response = self.post(VaultClient.url("auth/token/renew-self"), token=token)
+        except VaultUnavailable:
+            # keep the cached token; vault is just out of reach
+            raise
+        except Exception as e:
+            logger.warning("token renewal failed: %s" % (e,))
+            return None
+
+        if "errors" in response or "auth" not in response:
+            logger.info("token renewal refused: %s" % (response.get("errors"),))
+            return None
+        return response["auth"]
+
+    def login(self, role_id, secret_id):
+        self.count("logins")
+        return self.post(
+            VaultClient.url("auth/approle/login"),
+            payload=dict(secret_id=secret_id, role_id=role_id),
+            retry=False,
+        )
+
+    def unwrap(self, wrapping_token):
+        """the secret_id behind wrapping_token, unwrapped at most once"""
+        key = VaultClient.secret_digest(wrapping_token)
+        with self.lock:
+            secret_id = self.unwrapped.get(key)
+        if secret_id:
+            return secret_id
+
+        response = self.post(
+            VaultClient.url("sys/wrapping/unwrap"), token=wrapping_token, retry=False
+        )
+        if "errors" in response:
+            raise ValueError("\n".join(response["errors"]))
+        secret_id = (response.get("data") or {}).get("secret_id")
+        if secret_id:
+            with self.lock:
+                self.unwrapped[key] = secret_id
+        return secret_id
+
+    def forget_unwrapped(self, wrapping_token):
+        """vault answered a login with what wrapping_token held"""
+        with self.lock:
+            self.unwrapped.pop(VaultClient.secret_digest(wrapping_token), None)
+
+
+vault_client = VaultClient()
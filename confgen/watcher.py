@@ -1,66 +1,292 @@
-import json
-import os
-import signal
-import subprocess
 import threading
+from time import sleep, time
 
 import docker
 
-from gen import ConfGen
+from control import ControlError, ControlServer
+from gen import CertGen, ConfGen
+import tracing
+from jobs import CertJobs
+from metrics import (
+    WatcherCollector,
+    docker_errors,
+    docker_events,
+    exposition,
+    rebuild_phase_seconds,
+    rebuild_seconds,
+    registry,
+)
+from provider import ContainerProvider
+from reload import ReloadController
+from renewal import CertRenewer
+from scheduler import RebuildScheduler
+from service import Service
+from vault import vault_client
 from . import environ, logger
 
+# only what can change the config is sent by the daemon at all
+EVENT_FILTERS = {
+    "type": "container",
+    "event": ["start", "stop", "kill", "die", "destroy"],
+}
+# the daemon only buffers so many events; after a longer outage, list again
+EVENTS_RESYNC_AFTER = int(environ("EVENTS_RESYNC_AFTER", 300))
+EVENTS_BACKOFF_MAX = 30
+
 
 class Watcher:
     def __init__(self, vault_addr=None, vault_pki=None):
-        self.timer = None
+        self.scheduler = RebuildScheduler(
+            lambda force, fqdns: self.generate_config(force=force, fqdns=fqdns),
+            debounce=ConfGen.DEFER_TIME,
+        )
+        self.rebuild_lock = threading.Lock()
         self.client = docker.DockerClient(
-            base_url="unix://var/run/docker.sock",
+            base_url=environ("DOCKER_HOST", "unix://var/run/docker.sock"),
             version=environ("DOCKER_API_VERSION", None),
         )
         self.generator = ConfGen()
+        self.generator.certs.on_done = self.certificate_done
+        # /cert requests; each asks for one forced rebuild once issued
+        self.jobs = CertJobs(lambda: self.trigger_rebuild(force=True))
+        self.reloads = ReloadController()
+        self.renewer = CertRenewer(CertGen.index, self.generator.renew)
+        # retry the issuances skipped while open once a trial is allowed
+        vault_client.breaker.on_open = self.retry_after
+        self.provider = ContainerProvider(self.client)
+        # docker "since" of the last event handled, to resume the stream from
+        self.last_event = None
+        registry.register(WatcherCollector(self.stats))
+        # SIGUSR1 profiles the next few rebuilds
+        tracing.profiler.install()
 
     def begin_watch(self):
-        self.trigger_rebuild()
-        for event in self.client.events():
-            event = json.loads(event)
+        backoff = 1
+        disconnected_at = None
+        while True:
+            try:
+                events = self.subscribe()
+                if self.last_event is None:
+                    # subscribed before seeding, so nothing slips in between;
+                    # the first config has nothing to wait for
+                    self.provider.refresh()
+                    self.trigger_rebuild(urgent=True)
+                    self.renewer.start()
+                    Service.confs.start(self.custom_confs_changed)
+                elif time() - disconnected_at > EVENTS_RESYNC_AFTER:
+                    logger.warning("event stream was down too long; listing again")
+                    self.provider.refresh()
+                    self.trigger_rebuild()
+                else:
+                    logger.info("event stream resumed from %s" % (self.last_event,))
+                disconnected_at = None
+                backoff = 1
+
+                for event in events:
+                    self.consume(event)
+                logger.warning("event stream closed by the daemon")
+            except Exception as e:
+                docker_errors.labels("events").inc()
+                logger.warning("event stream failed: %s" % (e,))
+
+            disconnected_at = disconnected_at or time()
+            sleep(backoff)
+            backoff = min(backoff * 2, EVENTS_BACKOFF_MAX)
+
+    def subscribe(self):
+        # a resumed stream replays what was missed since the last event seen
+        return self.client.events(
+            filters=EVENT_FILTERS, decode=True, since=self.last_event
+        )
+
+    def consume(self, event):
+        docker_events.labels(event.get("status") or "unknown").inc()
+        try:
             self.handle_event(event)
+        except Exception as e:
+            logger.exception(e)
+
+        nanos = event.get("timeNano")
+        if nanos:
+            self.last_event = "%d.%09d" % divmod(nanos, 10 ** 9)
+        elif event.get("time"):
+            self.last_event = event["time"]
+
+    def containers(self):
+        return self.provider.containers()
+
+    def update_container(self, event):
+        container_id = event.get("id")
+        if not container_id:
+            return
+        if event.get("status") in ("die", "stop", "destroy"):
+            self.provider.evict(container_id)
+        else:
+            # only the container named by the event gets inspected
+            self.provider.update(container_id)
 
     def handle_event(self, event):
         status = event.get("status")
         logger.debug(
             [status, event.get("Actor", {}).get("Attributes", {}).get("name", "")]
         )
-        if status in ("start", "stop", "kill", "die"):
-            logger.debug(
-                "timer = %s, status = %s"
-                % (self.timer is not None, event.get("status"))
+        if status == "destroy":
+            self.update_container(event)
+        elif status in ("start", "stop", "kill", "die"):
+            # a serving container went away; get it out of its upstream quickly
+            urgent = (
+                status in ("die", "stop")
+                and event.get("id") in self.generator.upstream_ids
             )
-            self.trigger_rebuild()
+            logger.debug("status = %s, urgent = %s" % (status, urgent))
+            self.update_container(event)
+            self.trigger_rebuild(urgent=urgent)
+
+    def serve_control(self):
+        self.control = ControlServer(
+            dict(
+                ping=lambda: "PONG!",
+                cert=self.request_certificate,
+                cert_batch=self.request_certificates,
+                job=self.describe_job,
+                stats=self.stats,
+                metrics=exposition,
+            )
+        )
+        self.control.start()
+
+    def certificate_done(self, keys, ready):
+        # a landed certificate needs a reload even if the conf is unchanged;
+        # those asked for over /cert are reloaded once per job instead
+        if not self.jobs.issued(keys, ready) and ready:
+            self.trigger_rebuild(force=True)
 
-    def trigger_rebuild(self):
-        if not self.timer:
-            logger.debug("timer start")
-            self.timer = threading.Timer(ConfGen.DEFER_TIME, self.generate_config)
-            self.timer.start()
+    def request_certificate(self, payload):
+        """a new secret_id for a container; its certificate is issued again"""
+        queued = self.request_certificates([payload])
+        return dict(job=queued["job"], updated=queued["updated"][0])
 
-    def generate_config(self, force=None):
+    def request_certificates(self, payloads):
+        """issue again for each payload, as one job with one reload at the end"""
+        resolved = []
+        rejected = []
+        for n, payload in enumerate(payloads):
+            container = self.provider.lookup(payload)
+            if container is None:
+                rejected.append(dict(index=n, message="Container not found"))
+            else:
+                resolved.append((payload, container))
+        if not resolved:
+            raise ControlError("Container not found", status_code=404)
+
+        job = self.jobs.create()
+        # straight onto the cert queue; a running rebuild is not waited for
+        for payload, container in resolved:
+            CertGen.secret_updates[container.service_fqdn] = payload.get("secret_id")
+            cert_name = container.cert_name or container.service_fqdn
+            target = dict((k, v) for k, v in payload.items() if k != "secret_id")
+            entry = self.jobs.add(job, target, container.service_fqdn, cert_name)
+            self.generator.reissue(container)
+            if not self.generator.certs.is_pending(cert_name):
+                self.jobs.not_queued(job, entry, "not queued; see the watcher log")
+        self.jobs.seal(job)
+
+        return dict(
+            job=job["id"],
+            updated=[container.service_fqdn for _payload, container in resolved],
+            rejected=rejected,
+        )
+
+    def describe_job(self, job_id):
+        job = self.jobs.describe(job_id)
+        if job is None:
+            raise ControlError("Job not found", status_code=404)
+        return job
+
+    def stats(self):
+        return dict(
+            scheduler=self.scheduler.stats(),
+            containers=self.provider.stats(),
+            vault=vault_client.stats(),
+            reloads=self.reloads.stats(),
+            config=dict(
+                services=self.generator.service_count,
+                upstreams=len(self.generator.upstream_ids),
+            ),
+            certs=dict(
+                queue_depth=self.generator.certs.depth(),
+                generation=self.jobs.generation,
+            ),
+        )
+
+    def custom_confs_changed(self, fqdns):
+        # containers are not qualified again; split mode rewrites just these
+        logger.info("custom confs changed: %s" % (", ".join(fqdns),))
+        self.trigger_rebuild(fqdns=fqdns)
+
+    def trigger_rebuild(self, urgent=False, force=False, fqdns=None):
+        self.scheduler.request(urgent=urgent, force=force, fqdns=fqdns)
+
+    def retry_after(self, delay):
+        timer = threading.Timer(delay, self.trigger_rebuild)
+        timer.daemon = True
+        timer.start()
+
+    def generate_config(self, force=None, fqdns=None):
         logger.debug("generate config")
-        self.timer = None
-        if self.generator.generate(self.client) or force:
-            self.hup_frontend()
+        with tracing.rebuild():
+            # the scheduler runs one rebuild at a time; this covers direct callers
+            with self.rebuild_lock:
+                changed, reason, generation = self.rebuild_confs(force, fqdns)
 
-    def hup_frontend(self):
-        logger.info("Cycle frontend")
-        try:
-            cmd = "ps -ef | grep 'nginx: master' | grep -v grep | awk '{print $2}'"
-            proc = subprocess.check_output(cmd, shell=True).strip()
-            if not proc:
-                raise ValueError("no nginx process")
-
-            pid = int(proc)
-            os.kill(pid, signal.SIGHUP)
-            logger.info("Sent SIGHUP to pid %d" % (pid,))
-            return True
-        except Exception as e:
-            logger.exception(e)
-            raise
+            # waiting on nginx's new workers holds up no one else
+            done = lambda: self.jobs.rebuilt(generation)
+            with tracing.span("reload"):
+                if changed:
+                    self.reloads.request(reason, done=done)
+                elif force:
+                    self.reloads.request("forced", done=done)
+                else:
+                    done()
+
+    def rebuild_confs(self, force=None, fqdns=None):
+        """generate, validate and commit the confs; (changed, reason, generation)"""
+        started = time()
+        generation = self.jobs.rebuilding()
+        with tracing.span("list"):
+            containers = self.containers()
+        listed = time()
+        with tracing.span("generate"):
+            changed = self.generator.generate(containers, fqdns=fqdns)
+        reason = self.generator.reason
+        valid = True
+        if changed:
+            with tracing.span("validate"):
+                valid = self.reloads.validate(self.generator.prepare())
+        if not valid:
+            # nginx keeps running what it has; so does the conf dir
+            logger.error("keeping the previous config; rejected: %s" % (reason,))
+            self.generator.rollback()
+            changed = False
+        else:
+            # a held-back reload firing meanwhile waits for the whole tree,
+            # and for the upstream snapshot written with it
+            with self.reloads.conf_lock:
+                if self.generator.commit():
+                    # the balancer missed the new peers; a reload loads them
+                    changed = True
+                    reason = self.generator.reason
+        tracing.annotate(
+            generation=generation,
+            containers=len(containers),
+            changed=changed,
+            forced=bool(force),
+            rejected=not valid,
+            reason=reason,
+        )
+
+        rebuild_phase_seconds.labels("list").observe(listed - started)
+        for phase, seconds in self.generator.timings.items():
+            rebuild_phase_seconds.labels(phase).observe(seconds)
+        rebuild_seconds.observe(time() - started)
+        return changed, reason, generation
@@ -1,13 +1,13 @@
 import os
-from flask import Flask, request, jsonify
-from confgen.watcher import Watcher
-from confgen.container import Container
-from confgen.gen import CertGen
+from flask import Flask, Response, request, jsonify, url_for
+from prometheus_client import CONTENT_TYPE_LATEST
+from confgen.control import ControlClient, ControlError
 import logging
 
 app = Flask(__name__)
 logger = app.logger
-watcher = Watcher()
+# containers, certs and the config all live in the watcher process
+control = ControlClient()
 
 
 @app.before_first_request
@@ -58,21 +58,75 @@ def cert_update():
             raise ValueError("empty request or not json")
 
         validate_payload(payload)
-        container = identify_container(payload)
-        if not container:
-            raise InvalidUsage("Container not found", status_code=404)
+        # issuance is queued; poll the job to see it served
+        queued = control.call("cert", payload=payload)
+
+        return accepted(queued)
+    except ControlError as e:
+        raise InvalidUsage(e.message, status_code=e.status_code)
+    except InvalidUsage:
+        raise
+    except Exception as e:
+        raise InvalidUsage(str(e), status_code=400)
 
-        CertGen.secret_updates[container.service_fqdn] = payload.get("secret_id")
-        regen = watcher.generator.qualify_container(container, force_regen=True)
-        watcher.generate_config(force=regen)
 
-        return jsonify(regen=regen, updated=container.service_fqdn)
+@app.route("/cert/batch", methods=['POST'])
+def cert_batch():
+    try:
+        payload = request.json
+        if isinstance(payload, dict):
+            payload = payload.get("certs")
+        if not payload or not isinstance(payload, list):
+            raise ValueError("expected a json list of {target, secret_id} entries")
+
+        payloads = []
+        for n, entry in enumerate(payload):
+            if not isinstance(entry, dict) or not isinstance(entry.get("target"), dict):
+                raise ValueError("entry %d: target should be a dict identifying the container" % (n,))
+            flat = dict(entry["target"])
+            if "secret_id" in entry:
+                flat["secret_id"] = entry["secret_id"]
+            try:
+                validate_payload(flat)
+            except ValueError as e:
+                raise ValueError("entry %d: %s" % (n, e))
+            payloads.append(flat)
+
+        # one job, so the whole batch is served by a single reload
+        queued = control.call("cert_batch", payloads=payloads)
+
+        return accepted(queued)
+    except ControlError as e:
+        raise InvalidUsage(e.message, status_code=e.status_code)
     except InvalidUsage:
         raise
     except Exception as e:
         raise InvalidUsage(str(e), status_code=400)
 
 
+@app.route("/cert/jobs/<job_id>")
+def cert_job(job_id):
+    try:
+        return jsonify(control.call("job", job_id=job_id))
+    except ControlError as e:
+        raise InvalidUsage(e.message, status_code=e.status_code)
+
+
+@app.route("/metrics")
+def metrics():
+    try:
+        return Response(control.call("metrics"), content_type=CONTENT_TYPE_LATEST)
+    except ControlError as e:
+        raise InvalidUsage(e.message, status_code=e.status_code)
+
+
+def accepted(queued):
+    queued["status"] = url_for("cert_job", job_id=queued["job"])
+    response = jsonify(queued)
+    response.status_code = 202
+    return response
+
+
 def validate_payload(payload):
     if not isinstance(payload, (dict,)):
         raise ValueError("Payload not the appropriate dict type. Is a: " + type(payload))
@@ -88,39 +142,6 @@ def validate_payload(payload):
         raise ValueError("Payload is missing something to identify the target. Need at least one of: " + str(optionals))
 
 
-def identify_container(payload):
-    def id_log(container_prop, payload_prop):
-        logger.debug(
-            " [%s] %s == %s : %s",
-            payload_prop,
-            container_prop,
-            payload.get(payload_prop, ""),
-            container_prop == payload.get(payload_prop, "")
-        )
-
-    for container in watcher.client.containers.list():
-        container = Container(container)
-
-        id_log(container.service_fqdn, "domain")
-        if "domain" in payload and container.service_fqdn == payload["domain"]:
-            return container
-
-        id_log(container.service_fqdn, "cert_name")
-        if "virtual_host" in payload and container.service_fqdn == payload["virtual_host"]:
-            return container
-
-        id_log(container.service_fqdn, "cert_name")
-        if "cert_name" in payload and container.cert_name == payload["cert_name"]:
-            return container
-
-        id_log(container.name, "container_name")
-        if "container_name" in payload and container.name == payload["container_name"]:
-            return container
-
-        id_log(container.image, "image")
-        if "image" in payload and container.image == payload["image"]:
-            return container
-
-
 if __name__ == "__main__":
+    # development only; supervisord runs this under gunicorn
     app.run(host='0.0.0.0', port=44380)
@@ -2,8 +2,9 @@ from confgen.watcher import Watcher
 
 watcher = Watcher()
 
-# generate initial config on startup
-watcher.generate_config()
+# /cert requests reach the watcher through its control socket; served from the
+# start, as the first rebuild can take a while on a large host
+watcher.serve_control()
 
-# watch for future changes
+# seed the containers, generate the initial config and watch for changes
 watcher.begin_watch()